@@ -0,0 +1,424 @@
+"""
+Rewrite git history as if pbivcs had been used all along: in every commit of the given refs, each committed *.pbit (and
+*.pbix) is replaced by its extracted '.vcs' folder. The rewritten history is written to new refs (under
+refs/pbivcs-backfill/ by default) and the originals are left alone, so it can be checked before being adopted with e.g.
+
+    git update-ref refs/heads/main refs/pbivcs-backfill/heads/main
+
+Only git plumbing is used (cat-file, mktree, hash-object, ...). Each distinct pbit blob is only converted once, however
+many commits it appears in, and each distinct member (by the hash of its raw bytes and its converter) only once across
+all of them, with the conversions spread across a pool of worker processes. Progress is kept in a state folder (by
+default .git/pbivcs-backfill), so an interrupted run carries on where it left off:
+
+    python backfill.py [--repo PATH] [-j JOBS] [REF ...]
+"""
+
+import argparse
+import concurrent.futures
+import fnmatch
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import converters
+from document import PbitDocument
+from store import atomic_write, entry_key, entry_path
+
+DEFAULT_PATTERNS = ('*.pbit', '*.pbix')
+TREE_MODE = b'40000'
+FILE_MODE = b'100644'
+FAILED = '-'  # recorded instead of a tree for blobs which couldn't be extracted (and so are left as they are)
+CLAIM_SUFFIX = '.claim'
+CLAIM_POLL = 0.05  # how often (in seconds) a worker checks whether a member another worker has claimed is done
+
+
+def _member_path(members_dir, key):
+    return entry_path(members_dir, key)
+
+
+def read_member(members_dir, key):
+    """ The {vcs path: blob oid} member key was extracted to, or None if it hasn't been (yet) """
+    path = _member_path(members_dir, key)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_member(members_dir, key, oids):
+    # (atomically, so other processes never see a partial member)
+    with atomic_write(_member_path(members_dir, key), 'w') as f:
+        json.dump(oids, f)
+
+
+def claim_member(members_dir, key):
+    """
+    Try to claim member key for extracting, by creating its claim file (exclusively - so only one process can hold
+    it). Returns whether we got it, in which case it must be released with release_member.
+    """
+    path = _member_path(members_dir, key) + CLAIM_SUFFIX
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+    return True
+
+
+def release_member(members_dir, key):
+    os.remove(_member_path(members_dir, key) + CLAIM_SUFFIX)
+
+
+def remove_claims(members_dir):
+    """ Remove the claims left behind by an interrupted run (so only while no workers are running!) """
+    for root, dirs, files in os.walk(members_dir):
+        for name in files:
+            if name.endswith(CLAIM_SUFFIX):
+                os.remove(os.path.join(root, name))
+
+
+class Git:
+    """ Reads and writes objects in the repo at path, through long-running git plumbing processes """
+
+    def __init__(self, path):
+        self.path = path
+        self.git_dir = self.run('rev-parse', '--absolute-git-dir').decode('utf-8').strip()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self._cat = self._popen('cat-file', '--batch')
+        self._mktree = self._popen('mktree', '--batch', '-z')
+        self._hashers = {}
+
+    def _popen(self, *args):
+        return subprocess.Popen(('git', '-C', self.path) + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def run(self, *args):
+        return subprocess.run(('git', '-C', self.path) + args, check=True, stdout=subprocess.PIPE).stdout
+
+    def read(self, oid):
+        """ Return (type, content) of the object oid """
+        self._cat.stdin.write(oid.encode('ascii') + b'\n')
+        self._cat.stdin.flush()
+        header = self._cat.stdout.readline().split()
+        if len(header) != 3:
+            raise Exception('Cannot read git object {0}: {1}'.format(oid, b' '.join(header).decode('utf-8')))
+        content = self._cat.stdout.read(int(header[2]) + 1)[:-1]
+        return header[1].decode('ascii'), content
+
+    def read_tree(self, oid):
+        """ Return the entries of tree oid as a list of (mode, name, oid) - mode and name as bytes """
+        entries = []
+        content = self.read(oid)[1]
+        pos = 0
+        oid_size = len(oid) // 2
+        while pos < len(content):
+            space = content.index(b' ', pos)
+            nul = content.index(b'\0', space)
+            entries.append((content[pos:space], content[space + 1:nul], content[nul + 1:nul + 1 + oid_size].hex()))
+            pos = nul + 1 + oid_size
+        return entries
+
+    def write_tree(self, entries):
+        """ Write a tree of (mode, name, oid) entries, returning its oid """
+        for mode, name, oid in entries:
+            kind = b'tree' if mode == TREE_MODE else b'commit' if mode == b'160000' else b'blob'
+            self._mktree.stdin.write(mode + b' ' + kind + b' ' + oid.encode('ascii') + b'\t' + name + b'\0')
+        self._mktree.stdin.write(b'\0')
+        self._mktree.stdin.flush()
+        return self._mktree.stdout.readline().decode('ascii').strip()
+
+    def hash_paths(self, paths, kind='blob'):
+        """ Write the files at paths to the repo as objects of type kind, returning their oids """
+        if kind not in self._hashers:
+            self._hashers[kind] = self._popen('hash-object', '-w', '-t', kind, '--no-filters', '--stdin-paths')
+        hasher = self._hashers[kind]
+        oids = []
+        for path in paths:
+            hasher.stdin.write(os.fsencode(path) + b'\n')
+            hasher.stdin.flush()
+            oids.append(hasher.stdout.readline().decode('ascii').strip())
+        return oids
+
+    def write(self, kind, content):
+        path = os.path.join(self.tmpdir.name, 'object')
+        with open(path, 'wb') as f:
+            f.write(content)
+        return self.hash_paths([path], kind)[0]
+
+    def close(self):
+        for p in [self._cat, self._mktree] + list(self._hashers.values()):
+            p.stdin.close()
+            p.wait()
+        self.tmpdir.cleanup()
+
+
+class State:
+    """
+    What's been done so far, so that an interrupted backfill can carry on: the tree each pbit blob was extracted to,
+    and the commit each commit was rewritten as (both in append-only logs), and the blobs each member was extracted to
+    (a file per member in members_dir, which the worker processes write - see _extract_member).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.members_dir = os.path.join(path, 'members')
+        os.makedirs(self.members_dir, exist_ok=True)
+        self.blobs = self._load('blobs')
+        self.commits = self._load('commits')
+        self._logs = {}
+        for name in ('blobs', 'commits'):
+            f = self._logs[name] = open(os.path.join(path, name), 'a+')
+            f.seek(0, os.SEEK_END)
+            if f.tell():
+                # start on a new line, after any line left half written by an interruption:
+                f.seek(f.tell() - 1)
+                if f.read(1) != '\n':
+                    f.write('\n')
+
+    def _load(self, name):
+        mapping = {}
+        path = os.path.join(self.path, name)
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f.read().split("\n"):
+                    parts = line.split(' ')
+                    if len(parts) == 2 and parts[1]:  # (ignoring a line left half written by an interruption)
+                        mapping[parts[0]] = parts[1]
+        return mapping
+
+    def _log(self, name, key, value):
+        self._logs[name].write('{0} {1}\n'.format(key, value))
+        self._logs[name].flush()
+
+    def add_blob(self, blob, tree):
+        self.blobs[blob] = tree
+        self._log('blobs', blob, tree)
+
+    def add_commit(self, commit, new_commit):
+        self.commits[commit] = new_commit
+        self._log('commits', commit, new_commit)
+
+    def get_member(self, key):
+        return read_member(self.members_dir, key)
+
+    def close(self):
+        for f in self._logs.values():
+            f.close()
+
+
+def _extract_member(repo, doc, name, key, outdir, members_dir):
+    """ Extract member name of doc, writing its vcs files to the repo, and publish their oids as member key """
+    files = doc.vcs(name)
+    paths = []
+    for relpath, content in files.items():
+        path = os.path.join(outdir, key, *relpath.split('/')) if relpath else os.path.join(outdir, key, '_')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        paths.append(path)
+    oids = subprocess.run(('git', '-C', repo, 'hash-object', '-w', '--no-filters', '--stdin-paths'), check=True,
+                          input=b''.join(os.fsencode(path) + b'\n' for path in paths),
+                          stdout=subprocess.PIPE).stdout.decode('ascii').split()
+    write_member(members_dir, key, dict(zip(files, oids)))
+
+
+def _convert_blob(repo, blob, outdir, members_dir):
+    """
+    (In a worker process) extract the pbit blob, returning (blob, member names, [(name, member key)]). Each member
+    that's already been extracted (by any worker, for any blob) is reused - and only one worker ever extracts a given
+    member, as it has to claim it first. Others needing the same member wait for that one to publish it.
+    """
+    b = subprocess.run(('git', '-C', repo, 'cat-file', 'blob', blob), check=True, stdout=subprocess.PIPE).stdout
+    members = []
+    with PbitDocument(b) as doc:
+        for name in doc.names:
+            conv = doc.converter(name)
+            key = entry_key(converters.hash_bytes(doc.raw(name)), conv)
+            while read_member(members_dir, key) is None:
+                if not claim_member(members_dir, key):
+                    # someone else is extracting it:
+                    time.sleep(CLAIM_POLL)
+                    continue
+                try:
+                    # (it may have been published between us checking and claiming it)
+                    if read_member(members_dir, key) is None:
+                        _extract_member(repo, doc, name, key, outdir, members_dir)
+                finally:
+                    release_member(members_dir, key)
+            members.append((name, key))
+            doc.release(name)
+        return blob, doc.names, members
+
+
+class Backfill:
+
+    def __init__(self, git, state, patterns=DEFAULT_PATTERNS, outio=sys.stderr):
+        self.git = git
+        self.state = state
+        self.patterns = patterns
+        self.outio = outio
+        self._new_trees = {}
+
+    def is_pbit(self, name):
+        return any(fnmatch.fnmatch(name.lower(), pattern) for pattern in self.patterns)
+
+    def find_blobs(self, commits):
+        """ Find every pbit blob in the trees of commits """
+        blobs = set()
+        seen = set()
+        stack = [self.commit_tree(commit) for commit in commits]
+        while stack:
+            tree = stack.pop()
+            if tree in seen:
+                continue
+            seen.add(tree)
+            for mode, name, oid in self.git.read_tree(tree):
+                if mode == TREE_MODE:
+                    stack.append(oid)
+                elif mode.startswith(b'100') and self.is_pbit(os.fsdecode(name)):
+                    blobs.add(oid)
+        return blobs
+
+    def commit_tree(self, commit):
+        return self.git.read(commit)[1].split(b'\n', 1)[0].split(b' ')[1].decode('ascii')
+
+    def convert_blobs(self, blobs, jobs=None):
+        """ Extract each of blobs to a tree of its vcs files, across jobs worker processes """
+        remove_claims(self.state.members_dir)
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(_convert_blob, self.git.path, blob, os.path.join(tmpdir, blob),
+                                   self.state.members_dir): blob for blob in blobs}
+            for i, future in enumerate(concurrent.futures.as_completed(futures)):
+                blob = futures[future]
+                try:
+                    blob, order, members = future.result()
+                    tree = self._write_vcs_tree(order, members)
+                except Exception as e:
+                    print('FAILED to extract blob {0} (leaving it as it is): {1}: {2}'.format(blob, type(e).__name__, e),
+                          file=self.outio)
+                    tree = FAILED
+                self.state.add_blob(blob, tree)
+                print('{0}/{1} blobs extracted'.format(i + 1, len(futures)), file=self.outio)
+
+    def _write_vcs_tree(self, order, members):
+        files = {'.zo': self.git.write('blob', "\n".join(order).encode('utf-8'))}
+        for name, key in members:
+            oids = self.state.get_member(key)
+            if oids is None:
+                raise Exception('Member {0} was extracted, but has since gone missing'.format(name))
+            for relpath, oid in oids.items():
+                files[name + '/' + relpath if relpath else name] = oid
+        return self._write_nested_tree(files)
+
+    def _write_nested_tree(self, files):
+        """ Write a tree of {'/' separated path: blob oid}, returning its oid """
+        subdirs = {}
+        entries = []
+        for path, oid in files.items():
+            head, sep, rest = path.partition('/')
+            if sep:
+                subdirs.setdefault(head, {})[rest] = oid
+            else:
+                entries.append((FILE_MODE, head.encode('utf-8'), oid))
+        for name, subfiles in subdirs.items():
+            entries.append((TREE_MODE, name.encode('utf-8'), self._write_nested_tree(subfiles)))
+        return self.git.write_tree(entries)
+
+    def rewrite_tree(self, tree):
+        """ Return the oid of tree with each pbit blob in it (or below it) replaced by its '.vcs' folder """
+        if tree not in self._new_trees:
+            entries = {}
+            generated = set()
+            changed = False
+            for mode, name, oid in self.git.read_tree(tree):
+                if mode == TREE_MODE:
+                    new_oid = self.rewrite_tree(oid)
+                    changed = changed or new_oid != oid
+                    entries.setdefault(name, (mode, name, new_oid))
+                elif mode.startswith(b'100') and self.state.blobs.get(oid, FAILED) != FAILED and \
+                        self.is_pbit(os.fsdecode(name)):
+                    # (this replaces anything already committed where the extracted folder goes)
+                    vcs_name = name + b'.vcs'
+                    entries[vcs_name] = (TREE_MODE, vcs_name, self.state.blobs[oid])
+                    generated.add(vcs_name)
+                    changed = True
+                elif name not in generated:
+                    entries[name] = (mode, name, oid)
+            self._new_trees[tree] = self.git.write_tree(list(entries.values())) if changed else tree
+        return self._new_trees[tree]
+
+    def rewrite_commit(self, commit):
+        """ Write commit again with its tree rewritten and its parents mapped to their rewritten versions """
+        content = self.git.read(commit)[1]
+        headers, sep, message = content.partition(b'\n\n')
+        lines = []
+        changed = False
+        skipping = False
+        for line in headers.split(b'\n'):
+            if skipping and line.startswith(b' '):
+                continue
+            skipping = False
+            key, _, value = line.partition(b' ')
+            if key == b'tree':
+                new = self.rewrite_tree(value.decode('ascii'))
+                changed = changed or new != value.decode('ascii')
+                line = b'tree ' + new.encode('ascii')
+            elif key == b'parent':
+                new = self.state.commits.get(value.decode('ascii'), value.decode('ascii'))
+                changed = changed or new != value.decode('ascii')
+                line = b'parent ' + new.encode('ascii')
+            elif key in (b'gpgsig', b'gpgsig-sha256'):
+                # a signature can't survive the commit being rewritten (so drop it, along with its continuation lines)
+                skipping = True
+                continue
+            lines.append(line)
+        if not changed:
+            return commit
+        return self.git.write('commit', b'\n'.join(lines) + sep + message)
+
+    def run(self, refs, jobs=None, ref_prefix='refs/pbivcs-backfill/'):
+        commits = self.git.run('rev-list', '--reverse', '--topo-order', *refs).decode('ascii').split()
+        todo = [commit for commit in commits if commit not in self.state.commits]
+        blobs = [blob for blob in self.find_blobs(todo) if blob not in self.state.blobs]
+        print('{0} commits ({1} to rewrite), {2} pbit blobs to extract'.format(len(commits), len(todo), len(blobs)),
+              file=self.outio)
+        if blobs:
+            self.convert_blobs(blobs, jobs)
+        for i, commit in enumerate(todo):
+            self.state.add_commit(commit, self.rewrite_commit(commit))
+            if (i + 1) % 100 == 0 or i + 1 == len(todo):
+                print('{0}/{1} commits rewritten'.format(i + 1, len(todo)), file=self.outio)
+        for ref in refs:
+            old = self.git.run('rev-parse', '--verify', ref + '^{commit}').decode('ascii').strip()
+            new_ref = ref_prefix + ref[len('refs/'):] if ref.startswith('refs/') else ref_prefix + ref
+            self.git.run('update-ref', new_ref, self.state.commits[old])
+            print('{0} -> {1}'.format(new_ref, self.state.commits[old]), file=self.outio)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rewrite git history replacing committed *.pbit (and *.pbix) with their extracted '.vcs' folders")
+    parser.add_argument('refs', nargs='*', help="the refs to rewrite (default: all branches)")
+    parser.add_argument('--repo', default='.', help="the git repository")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="number of worker processes to extract blobs across (defaults to the number of cores)")
+    parser.add_argument('--state', default=None, help="where to keep progress, so an interrupted run can be resumed (default: pbivcs-backfill in the git folder)")
+    parser.add_argument('--pattern', dest='patterns', action='append', default=None, help="file names to extract (default: *.pbit and *.pbix). Can be repeated")
+    parser.add_argument('--ref-prefix', default='refs/pbivcs-backfill/', help="where to write the rewritten refs (e.g. refs/heads/main goes to <prefix>heads/main)")
+    args = parser.parse_args(argv)
+
+    git = Git(args.repo)
+    state = State(args.state or os.path.join(git.git_dir, 'pbivcs-backfill'))
+    try:
+        refs = args.refs or git.run('for-each-ref', '--format=%(refname)', 'refs/heads').decode('utf-8').split()
+        Backfill(git, state, tuple(p.lower() for p in args.patterns or DEFAULT_PATTERNS)).run(refs, args.jobs,
+                                                                                            args.ref_prefix)
+    finally:
+        state.close()
+        git.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,205 @@
+"""
+Benchmarks for pbivcs: times extract, compress, textconv and a full round trip over every *.pbit in samples/ (plus
+copies of one of them with Report/Layout scaled up, e.g. to 10x and 100x as many visualContainers), recording the wall
+time, time per converter and peak memory of each stage. Results can be saved as JSON and compared against an earlier
+run, failing if anything has regressed by more than a threshold. It also times starting up a fresh pbivcs process,
+which is what git pays for every file it runs us on:
+
+    python bench.py -o before.json
+    ... make changes ...
+    python bench.py -o after.json --compare before.json --threshold 0.2
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from io import StringIO
+
+import converters
+import pbivcs
+
+STAGES = ('extract', 'compress', 'textconv', 'roundtrip')
+PBIVCS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pbivcs.py')
+
+
+def make_scaled_pbit(pbit_path, factor, outpath):
+    """ Copy pbit_path to outpath, but with every page of Report/Layout having factor times as many visualContainers """
+    with zipfile.ZipFile(pbit_path) as zin, zipfile.ZipFile(outpath, 'w', compression=zipfile.ZIP_DEFLATED) as zout:
+        for name in zin.namelist():
+            b = zin.read(name)
+            if name == 'Report/Layout':
+                layout = json.loads(b.decode('utf-16-le'))
+                for section in layout.get('sections', []):
+                    section['visualContainers'] = section.get('visualContainers', []) * factor
+                b = json.dumps(layout, separators=(',', ':'), ensure_ascii=False).encode('utf-16-le')
+            zout.writestr(name, b)
+
+
+def _run_stage(stage, pbit_path, workdir):
+    vcsdir = os.path.join(workdir, 'vcs')
+    if stage == 'extract':
+        pbivcs.extract_pbit(pbit_path, vcsdir, True)
+    elif stage == 'compress':
+        pbivcs.compress_pbit(vcsdir, os.path.join(workdir, 'out.pbit'), True)
+    elif stage == 'textconv':
+        pbivcs.textconv_pbit(pbit_path, StringIO())
+    elif stage == 'roundtrip':
+        pbivcs.extract_pbit(pbit_path, os.path.join(workdir, 'rt.vcs'), True)
+        pbivcs.compress_pbit(os.path.join(workdir, 'rt.vcs'), os.path.join(workdir, 'rt.pbit'), True)
+
+
+def _time_converters(stage, pbit_path, workdir):
+    """ Run the stage recording converter stats, returning the total seconds spent in each converter class """
+    converters.Converter.stats = converters.Stats()
+    try:
+        _run_stage(stage, pbit_path, workdir)
+        return {conv: total['read'] + total['convert'] + total['write']
+                for conv, total in converters.Converter.stats.by_converter().items()}
+    finally:
+        converters.Converter.stats = None
+
+
+def bench_pbit(pbit_path, repeat, memory):
+    """ Benchmark each stage on pbit_path, returning {stage: {'wall': ..., 'converters': ..., 'peak_memory': ...}} """
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        # compress needs something to compress:
+        pbivcs.extract_pbit(pbit_path, os.path.join(workdir, 'vcs'), True)
+        for stage in STAGES:
+            walls = []
+            for i in range(repeat):
+                t = time.perf_counter()
+                _run_stage(stage, pbit_path, workdir)
+                walls.append(time.perf_counter() - t)
+            result = {'wall': min(walls), 'converters': _time_converters(stage, pbit_path, workdir)}
+            if memory:
+                # (in a separate run, as tracing slows everything down)
+                tracemalloc.start()
+                _run_stage(stage, pbit_path, workdir)
+                result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            results[stage] = result
+    return results
+
+
+def _time_process(cmd, repeat):
+    """ The quickest of repeat runs of the command cmd, in seconds """
+    walls = []
+    for i in range(repeat):
+        t = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+        walls.append(time.perf_counter() - t)
+    return min(walls)
+
+
+def bench_startup(pbit_path, repeat):
+    """
+    Time starting a fresh process: the bare interpreter, importing pbivcs, and pbivcs -s on pbit_path with a warm
+    textconv cache (i.e. git's textconv of an unchanged file, where startup is nearly all of the work). Returns
+    {stage: {'wall': ...}}, like bench_pbit.
+    """
+    with tempfile.TemporaryDirectory() as cachedir:
+        textconv = [sys.executable, PBIVCS, '-s', '--textconv-cache', cachedir, pbit_path]
+        subprocess.run(textconv, stdout=subprocess.DEVNULL, check=True)  # warm the cache
+        return {
+            'interpreter': {'wall': _time_process([sys.executable, '-c', 'pass'], repeat)},
+            'import': {'wall': _time_process([sys.executable, '-c', 'import sys; sys.path.insert(0, sys.argv[1]); '
+                                              'import pbivcs', os.path.dirname(PBIVCS)], repeat)},
+            'textconv-cached': {'wall': _time_process(textconv, repeat)},
+        }
+
+
+def compare(results, baseline, threshold, outio=sys.stdout):
+    """ Print how results compare to baseline, returning the list of regressions (more than threshold slower/bigger) """
+    regressions = []
+    for label, stages in sorted(results['results'].items()):
+        for stage, result in stages.items():
+            old = baseline['results'].get(label, {}).get(stage)
+            if old is None:
+                continue
+            for metric in ('wall', 'peak_memory'):
+                if metric not in result or not old.get(metric):
+                    continue
+                ratio = result[metric] / old[metric]
+                flag = ''
+                if ratio > 1 + threshold:
+                    flag = '  <-- REGRESSION'
+                    regressions.append((label, stage, metric, ratio))
+                print('{0:50} {1:10} {2:12} {3:7.2f}x{4}'.format(label[:50], stage, metric, ratio, flag), file=outio)
+    return regressions
+
+
+def _format_memory(b):
+    return '{0:.1f} MiB'.format(b / 1024 / 1024) if b is not None else '-'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark pbivcs over the sample *.pbit files")
+    parser.add_argument('--samples', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples'), help="folder of *.pbit files to benchmark")
+    parser.add_argument('--scales', default='10,100', help="comma separated factors to scale up Report/Layout's visualContainers by (empty for none)")
+    parser.add_argument('--scale-base', default=None, help="the pbit to scale up (defaults to the sample with the biggest Report/Layout)")
+    parser.add_argument('--repeat', type=int, default=3, help="run each stage this many times, taking the quickest")
+    parser.add_argument('--no-memory', action='store_false', dest='memory', help="don't measure peak memory (which needs an extra, slower, run of each stage)")
+    parser.add_argument('--startup-repeat', type=int, default=20, help="start a fresh process this many times for each startup stage, taking the quickest (0 to skip them)")
+    parser.add_argument('-o', '--output', default=None, help="save the results as JSON to this path")
+    parser.add_argument('--compare', default=None, help="compare against the results JSON of an earlier run")
+    parser.add_argument('--threshold', type=float, default=0.2, help="with --compare, fail if anything is this fraction slower/bigger")
+    args = parser.parse_args(argv)
+
+    pbits = sorted(glob.glob(os.path.join(glob.escape(args.samples), '*.pbit')))
+    if not pbits:
+        parser.error('No *.pbit files found in "{0}"'.format(args.samples))
+    scales = [int(s) for s in args.scales.split(',') if s.strip()]
+
+    results = {
+        'meta': {'python': sys.version, 'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                 'repeat': args.repeat},
+        'results': {}
+    }
+    with tempfile.TemporaryDirectory() as scaledir:
+        inputs = [(os.path.basename(p), p) for p in pbits]
+        if scales:
+            base = args.scale_base
+            if base is None:
+                base = max(pbits, key=lambda p: zipfile.ZipFile(p).getinfo('Report/Layout').file_size)
+            for factor in scales:
+                scaled = os.path.join(scaledir, '{0}x.pbit'.format(factor))
+                make_scaled_pbit(base, factor, scaled)
+                inputs.append(('{0} (layout x{1})'.format(os.path.basename(base), factor), scaled))
+
+        for label, path in inputs:
+            results['results'][label] = stages = bench_pbit(path, args.repeat, args.memory)
+            for stage, result in stages.items():
+                slowest = max(result['converters'].items(), key=lambda kv: kv[1], default=('-', 0))
+                print('{0:50} {1:10} {2:8.3f}s {3:>10}  (slowest converter: {4} {5:.3f}s)'.format(
+                    label[:50], stage, result['wall'], _format_memory(result.get('peak_memory')), *slowest))
+
+    if args.startup_repeat:
+        results['results']['(startup)'] = stages = bench_startup(min(pbits, key=os.path.getsize), args.startup_repeat)
+        for stage, result in stages.items():
+            print('{0:50} {1:10} {2:8.3f}s'.format('(startup)', stage, result['wall']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('{0} regression(s) beyond {1:.0%}'.format(len(regressions), args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+import hashlib
+import os
+import time
+from io import BytesIO
+
+import converters
+from converters import CHUNK_SIZE
+from store import entry_path
+
+POINTER_HEADER = b'# pbivcs blob\n'
+POINTER_MAX_SIZE = 1024  # anything bigger than this can't be a pointer file
+GC_GRACE = 60 * 60  # blobs stored (or reused) in the last this many seconds are never garbage collected
+
+
+def pointer(digest, size):
+    """ The content of a pointer file, standing in for a blob in the vcs folder """
+    return POINTER_HEADER + 'sha256 {0}\nsize {1}\n'.format(digest, size).encode('ascii')
+
+
+def parse_pointer(b):
+    """ Return the (sha256, size) of the blob pointed to by b, the content of a pointer file (or None if it isn't one) """
+    if not b.startswith(POINTER_HEADER) or len(b) > POINTER_MAX_SIZE:
+        return None
+    fields = dict(line.split(' ', 1) for line in b[len(POINTER_HEADER):].decode('ascii').split("\n") if ' ' in line)
+    try:
+        digest, size = fields['sha256'], int(fields['size'])
+    except (KeyError, ValueError):
+        raise Exception('Bad blob pointer: {0!r}'.format(b))
+    return digest, size
+
+
+def read_pointer(path):
+    """ parse_pointer the file at path, without reading it if it's too big to be a pointer """
+    if not os.path.isfile(path) or os.path.getsize(path) > POINTER_MAX_SIZE:
+        return None
+    with open(path, 'rb') as f:
+        return parse_pointer(f.read())
+
+
+def find_pointers(root):
+    """ Yield the (sha256, size) of every pointer file under root (or root itself, if it's a file) """
+    if os.path.isfile(root):
+        p = read_pointer(root)
+        if p is not None:
+            yield p
+        return
+    for dirpath, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if d != '.git']
+        for name in files:
+            p = read_pointer(os.path.join(dirpath, name))
+            if p is not None:
+                yield p
+
+
+def _git(root, *args, input=None):
+    import subprocess
+
+    return subprocess.run(('git', '-C', root) + args, input=input, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                          check=True).stdout
+
+
+def find_git_pointers(root):
+    """
+    Yield the (sha256, size) of every pointer file in any commit reachable from a ref of the git repo containing root
+    (if it's in one), so that checking out an old version still finds its blobs.
+    """
+    from subprocess import CalledProcessError
+
+    try:
+        _git(root, 'rev-parse', '--git-dir')
+    except (OSError, CalledProcessError):
+        return
+    ids = b''.join(line.split(b' ', 1)[0] + b'\n' for line in _git(root, 'rev-list', '--objects', '--all').splitlines())
+    checks = _git(root, 'cat-file', '--batch-check=%(objectname) %(objecttype) %(objectsize)', input=ids)
+    small = b''.join(oid + b'\n' for oid, kind, size in (line.split() for line in checks.splitlines())
+                     if kind == b'blob' and int(size) <= POINTER_MAX_SIZE)
+    out = _git(root, 'cat-file', '--batch', input=small)
+    pos = 0
+    while pos < len(out):
+        end = out.index(b'\n', pos)
+        size = int(out[pos:end].split()[2])
+        p = parse_pointer(out[end + 1:end + 1 + size])
+        if p is not None:
+            yield p
+        pos = end + 1 + size + 1
+
+
+class BlobStore:
+    """
+    An out-of-tree, content-addressed store of (large, binary) member content, so that the vcs folder only needs a
+    small pointer file (see pointer) for each, and the repo doesn't grow by a copy of e.g. every image on every save.
+    Blobs are named by the sha256 of their content, so they're deduplicated across versions and reports. Members of
+    at least min_size bytes are stored here (see BlobConverter).
+    """
+
+    SUFFIX = '.blob'
+
+    def __init__(self, path, min_size=0):
+        self.path = path
+        self.min_size = min_size
+
+    def _blob_path(self, digest):
+        return entry_path(self.path, digest, self.SUFFIX)
+
+    def put(self, rawf):
+        """ Stream rawf in to the store a chunk at a time (hashing it as it goes), returning its (sha256, size) """
+        import tempfile
+
+        os.makedirs(self.path, exist_ok=True)
+        sha = hashlib.sha256()
+        size = 0
+        # write then rename, so concurrent readers never see a partial blob:
+        fd, tmppath = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    b = rawf.read(CHUNK_SIZE)
+                    if not b:
+                        break
+                    sha.update(b)
+                    size += len(b)
+                    f.write(b)
+            digest = sha.hexdigest()
+            path = self._blob_path(digest)
+            if os.path.isfile(path):
+                # already stored - just mark it as recently used, for gc:
+                os.remove(tmppath)
+                os.utime(path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmppath, path)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+        return digest, size
+
+    def copy_to(self, digest, size, out):
+        """ Stream the blob with the given sha256 and size to the writable out, checking it's intact as it goes """
+        path = self._blob_path(digest)
+        if not os.path.isfile(path):
+            raise Exception('Blob {0} is missing from the blob store "{1}"'.format(digest, self.path))
+        sha = hashlib.sha256()
+        copied = 0
+        with open(path, 'rb') as f:
+            while True:
+                b = f.read(CHUNK_SIZE)
+                if not b:
+                    break
+                sha.update(b)
+                copied += len(b)
+                out.write(b)
+        if copied != size or sha.hexdigest() != digest:
+            raise Exception('Blob {0} in the blob store "{1}" is corrupt'.format(digest, self.path))
+
+    def gc(self, roots, grace=GC_GRACE):
+        """
+        Remove every blob which isn't pointed to by a pointer file under any of roots - nor by any commit of the git
+        repos they're in - other than those stored or reused in the last grace seconds (e.g. by an extract that's
+        still running). Every repo and folder using the store must be in roots! Returns (blobs removed, bytes freed).
+        """
+        live = set()
+        for root in roots:
+            if not os.path.exists(root):
+                # (a typo here would otherwise lose everything it points to)
+                raise Exception('Blob gc root "{0}" does not exist'.format(root))
+            live.update(digest for digest, size in find_pointers(root))
+            live.update(digest for digest, size in find_git_pointers(root))
+        cutoff = time.time() - grace
+        removed = freed = 0
+        for dirpath, dirs, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(dirpath, name)
+                if name.endswith(self.SUFFIX) and name[:-len(self.SUFFIX)] in live:
+                    continue
+                if not (name.endswith(self.SUFFIX) or name.endswith('.tmp')):
+                    continue
+                try:
+                    st = os.stat(path)
+                    if st.st_mtime >= cutoff:
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+                freed += st.st_size
+        return removed, freed
+
+
+class BlobConverter(converters.Converter):
+    """ Keeps a member in a BlobStore, with just a pointer to it in the vcs folder """
+
+    def __init__(self, store):
+        self.store = store
+
+    def cache_id(self):
+        # (a blob is the same blob whichever store it's in)
+        return '{0}/{1}'.format(type(self).__name__, self.VERSION)
+
+    def raw_to_vcs(self, b):
+        return pointer(*self.store.put(converters.MemoryViewReader(b)))
+
+    def vcs_to_raw(self, b):
+        out = BytesIO()
+        self.store.copy_to(*self._parse(b), out)
+        return out.getvalue()
+
+    def raw_to_textconv(self, b):
+        return "File hash: " + converters.hash_bytes(b) + "\n"
+
+    def _parse(self, b):
+        p = parse_pointer(b)
+        if p is None:
+            raise Exception('Expected a blob pointer, not {0!r}...'.format(bytes(b[:len(POINTER_HEADER)])))
+        return p
+
+    def write_rawstream_to_vcs(self, rawf, vcspath):
+        converters.write_if_changed(vcspath, pointer(*self.store.put(rawf)))
+
+    def write_vcs_to_raw(self, vcspath, rawzip):
+        with open(vcspath, 'rb') as f:
+            self.store.copy_to(*self._parse(f.read(POINTER_MAX_SIZE + 1)), rawzip)
+
+    def write_rawstream_to_textconv(self, rawf, outio):
+        print("File hash: " + converters.hash_stream(rawf) + "\n", file=outio)
@@ -0,0 +1,105 @@
+import os
+
+from store import atomic_write, entry_key, entry_path
+
+
+class TextconvCache:
+    """
+    A persistent, content-addressed cache of textconv output. Entries are keyed by the hash of a member's raw bytes
+    along with the identity (and version) of the converter used, so identical members across revisions (or reports)
+    are only ever converted once. Each entry is a file (named by its key) under path, and its mtime records when it was
+    last used, so that the least recently used entries can be evicted once the cache grows beyond max_bytes.
+
+    So that checking whether it has grown too big doesn't mean stat'ing every entry on every run, the total size found
+    by the last full scan is kept in SIZE_FILE, and the size of each entry put since is appended to ADDED_FILE. Only
+    when those add up to more than max_bytes is the cache scanned (and trimmed) again.
+    """
+
+    SUFFIX = '.txt'
+    SIZE_FILE = 'size'
+    ADDED_FILE = 'added'
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.added = False  # whether we've put anything (so the cache may need trimming)
+
+    def key(self, member_hash, conv):
+        return entry_key(member_hash, conv)
+
+    def _entry_path(self, key):
+        return entry_path(self.path, key, self.SUFFIX)
+
+    def get(self, key):
+        """ Return the cached text for key, or None if it isn't cached """
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                text = f.read().decode('utf-8')
+            os.utime(path)  # mark it as recently used
+        except FileNotFoundError:
+            # (it may also have been evicted by another process between the open and the utime)
+            return None
+        return text
+
+    def put(self, key, text):
+        b = text.encode('utf-8')
+        with atomic_write(self._entry_path(key)) as f:
+            f.write(b)
+        # (an entry that's put again is counted twice, which only makes the next scan come sooner)
+        with open(os.path.join(self.path, self.ADDED_FILE), 'a') as f:
+            f.write('{0}\n'.format(len(b)))
+        self.added = True
+
+    def _estimated_size(self):
+        """ The size as of the last scan plus everything put since, or None if it's never been scanned """
+        try:
+            with open(os.path.join(self.path, self.SIZE_FILE)) as f:
+                size = int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            with open(os.path.join(self.path, self.ADDED_FILE)) as f:
+                size += sum(int(line) for line in f.read().split("\n") if line.isdigit())
+        except FileNotFoundError:
+            pass
+        return size
+
+    def trim(self):
+        """
+        Evict the least recently used entries until the cache is no bigger than max_bytes. This does nothing unless
+        we've put something, and only scans the cache if that may have taken it over max_bytes.
+        """
+        if not self.added:
+            return
+        size = self._estimated_size()
+        if size is not None and size <= self.max_bytes:
+            return
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                if name.endswith(self.SUFFIX):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+                    total += st.st_size
+        if total > self.max_bytes:
+            for mtime, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= self.max_bytes:
+                    break
+        # record where we're up to (an entry put by another process while we were scanning may be missed from the
+        # total, until the next scan):
+        with atomic_write(os.path.join(self.path, self.SIZE_FILE), 'w') as f:
+            f.write(str(total))
+        with open(os.path.join(self.path, self.ADDED_FILE), 'w'):
+            pass
+        self.added = False
@@ -1,15 +1,487 @@
-import zipfile
+# (lxml, orjson, zipfile and struct are only imported by the converters that use them, when they're first used - so
+# e.g. a git textconv served from the cache doesn't pay for loading them)
 import json
 import re
 from io import BytesIO
-import struct
-from lxml import etree
 import os
-import ast
+import hashlib
+import shutil
+import io
+import codecs
+import time
+import contextlib
+import functools
+
+
+MANIFEST_FILE = '.zh'  # only written by incremental extracts, and never part of the flattened form
+MANIFEST_HEADER = '# pbivcs manifest 2'
+JSON_WHITESPACE = ' \t\n\r'
+LONG_DIGITS_RE = re.compile('[0-9]{19}')
+CHUNK_SIZE = 1 << 20  # pass-through content is streamed in chunks of this size, so memory use doesn't grow with it
+
+
+def hash_bytes(b):
+    return hashlib.sha256(b).hexdigest()
+
+
+class HashingReader:
+    """ Wraps a readable (e.g. zip member) stream, hashing everything read through it """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha = hashlib.sha256()
+
+    def read(self, n=-1):
+        b = self.f.read(n)
+        self.sha.update(b)
+        return b
+
+    def hexdigest(self):
+        # hash anything that wasn't read:
+        for b in iter(lambda: self.f.read(CHUNK_SIZE), b''):
+            self.sha.update(b)
+        return self.sha.hexdigest()
+
+
+class HashingWriter:
+    """ A writable stream which just hashes (and counts) what's written to it, rather than keeping it """
+
+    def __init__(self):
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def write(self, b):
+        self.sha.update(b)
+        self.size += len(b)
+        return len(b)
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+class MemoryViewReader(io.RawIOBase):
+    """ A read-only, seekable file over a memoryview (or bytes), so e.g. ZipFile can read it in place, without a copy """
+
+    def __init__(self, b):
+        self.view = memoryview(b)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError("Negative seek position {0}".format(offset))
+        self.pos = offset
+        return self.pos
+
+    def read(self, n=-1):
+        end = len(self.view) if n is None or n < 0 else min(self.pos + n, len(self.view))
+        b = self.view[self.pos:end].tobytes() if end > self.pos else b''
+        self.pos = max(self.pos, end)
+        return b
+
+    def readinto(self, b):
+        chunk = self.read(len(b))
+        b[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def hash_stream(f):
+    return HashingReader(f).hexdigest()
+
+
+def hash_vcs(path):
+    """ Hash the extracted form of a member - a file or (e.g. for DataMashup) a folder of them """
+    if not os.path.isdir(path):
+        with open(path, 'rb') as f:
+            return hash_stream(f)
+    sha = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name != MANIFEST_FILE:
+                filepath = os.path.join(root, name)
+                sha.update(os.path.relpath(filepath, path).replace(os.sep, '/').encode('utf-8') + b'\0')
+                sha.update(hash_vcs(filepath).encode('ascii'))
+    return sha.hexdigest()
+
+
+class ChangedFileWriter(io.RawIOBase):
+    """
+    A write-only file which leaves path untouched (e.g. keeps its mtime) if exactly the same content is written to it.
+    What's written is compared against the existing file as it arrives, and only on the first difference do we start
+    writing (to a temporary file, which replaces path on close) - so nothing is ever held in memory. If an exception
+    is raised inside the with block, path is left as it was. Unless stats is False (e.g. for manifests and order files,
+    which aren't part of a member's output), writes are recorded in Converter.stats.
+    """
+
+    def __init__(self, path, stats=True):
+        self.path = path
+        self.stats = stats
+        self.changed = False
+        self._pos = 0
+        self._new = None
+        self._old = open(path, 'rb') if os.path.isfile(path) else None
+        if self._old is None:
+            self._start_writing()
+
+    def writable(self):
+        return True
+
+    def _start_writing(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._new = open(self.path + '.pbivcs-tmp', 'wb')
+        if self._old is not None:
+            # copy across the matching bit we've skipped so far:
+            self._old.seek(0)
+            remaining = self._pos
+            while remaining:
+                b = self._old.read(min(remaining, CHUNK_SIZE))
+                self._new.write(b)
+                remaining -= len(b)
+        self.changed = True
+
+    def write(self, b):
+        if Converter.stats is not None and self.stats:
+            start = time.perf_counter()
+            n = self._write(b)
+            Converter.stats.add('write', time.perf_counter() - start)
+            Converter.stats.add('out_size', n)
+            return n
+        return self._write(b)
+
+    def _write(self, b):
+        n = len(b)
+        if self._new is None:
+            if self._old.read(n) == b:
+                self._pos += n
+                return n
+            self._start_writing()
+        self._new.write(b)
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        if self._new is None and self._old.read(1):
+            # the existing file is longer than what we've written:
+            self._start_writing()
+        if self._old is not None:
+            self._old.close()
+        if self._new is not None:
+            self._new.close()
+            try:
+                os.replace(self._new.name, self.path)
+            except BaseException:
+                # (e.g. path is now a folder) - don't leave the temporary file behind:
+                os.remove(self._new.name)
+                super().close()
+                raise
+        super().close()
+
+    def abort(self):
+        if self._old is not None:
+            self._old.close()
+        if self._new is not None:
+            self._new.close()
+            os.remove(self._new.name)
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_if_changed(path, b, stats=True):
+    """ Write b to path unless it already holds exactly b - so unchanged files keep their mtime. Returns True if written. """
+    with ChangedFileWriter(path, stats) as f:
+        f.write(b)
+    return f.changed
+
+
+def write_text(chunks, f, encoding):
+    """
+    Encode an iterable of strings (e.g. from JSONEncoder.iterencode) to the binary file f a bit at a time, rather than
+    joining them and holding a second, encoded, copy in memory.
+    """
+    encoder = codecs.getincrementalencoder(encoding)()
+    buf, size = [], 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= CHUNK_SIZE:
+            f.write(encoder.encode(''.join(buf)))
+            buf, size = [], 0
+    f.write(encoder.encode(''.join(buf), final=True))
+
+
+@functools.lru_cache(maxsize=None)
+def _orjson():
+    """ The orjson module, or None if it's not installed (it's optional - it just makes parsing json quicker) """
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+def json_loads(s):
+    """
+    json.loads, but using orjson (if it's installed) as it's much quicker. It parses to exactly the same objects, except
+    that it's a bit stricter (e.g. no NaN or lone surrogates) - in which case we fall back to json - and it turns ints
+    beyond 64 bits into floats - so we don't use it if there are any long runs of digits.
+    """
+    orjson = _orjson()
+    if orjson is not None and not LONG_DIGITS_RE.search(s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(s)
+
+
+def could_be_json_container(s):
+    """ A cheap check for whether s could possibly be a json object/array, before bothering to try and parse it """
+    first, last = s[:1], s[-1:]
+    if not first:
+        return False
+    if first in JSON_WHITESPACE or last in JSON_WHITESPACE:
+        s = s.strip(JSON_WHITESPACE)
+        first, last = s[:1], s[-1:]
+    return (first == '{' and last == '}') or (first == '[' and last == ']')
+
+
+def split_text(s):
+    return (s[i:i + CHUNK_SIZE] for i in range(0, len(s), CHUNK_SIZE))
+
+
+def read_manifest(vcsdir):
+    """
+    Read the hash manifest written next to .zo, as {name: (raw hash, vcs hash, converter name)}. After the
+    MANIFEST_HEADER line, each line is '<sha256 of raw bytes> <hash_vcs of the output> <converter class> <member name>'.
+    A manifest in an older format is ignored (so everything is converted again, once).
+    """
+    manifest = {}
+    path = os.path.join(vcsdir, MANIFEST_FILE)
+    if os.path.isfile(path):
+        with open(path) as f:
+            lines = f.read().split("\n")
+        if lines[0] == MANIFEST_HEADER:
+            for line in lines[1:]:
+                if line:
+                    h, vcs_h, conv, name = line.split(' ', 3)
+                    manifest[name] = (h, vcs_h, conv)
+    return manifest
+
+
+def write_manifest(vcsdir, entries):
+    """ entries is a list of (name, raw hash, vcs hash, converter name), in archive order """
+    lines = [MANIFEST_HEADER] + ['{0} {1} {2} {3}'.format(h, vcs_h, conv, name) for name, h, vcs_h, conv in entries]
+    write_if_changed(os.path.join(vcsdir, MANIFEST_FILE), "\n".join(lines).encode('utf-8'), stats=False)
+
+
+def is_unchanged(old_manifest, name, raw_hash, convname, vcspath):
+    """
+    Whether vcspath still holds exactly what old_manifest says was extracted there from raw bytes with hash raw_hash
+    by the converter convname - i.e. the member hasn't changed, and nor has its output (e.g. by hand) since
+    """
+    old = old_manifest.get(name)
+    return (old is not None and old[0] == raw_hash and old[2] == convname and os.path.exists(vcspath)
+            and old[1] == hash_vcs(vcspath))
+
+
+@contextlib.contextmanager
+def keeping_manifests(keep=True):
+    """ Within this, converters which write a folder (i.e. DataMashupConverter) keep a manifest in it, if keep """
+    was = Converter.keep_manifests
+    Converter.keep_manifests = keep
+    try:
+        yield
+    finally:
+        Converter.keep_manifests = was
+
+
+def read_order(vcsdir):
+    path = os.path.join(vcsdir, ".zo")
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return f.read().split("\n")
+
+
+def remove_stale(vcsdir, old_order, order):
+    """ Remove the outputs of members which were previously extracted but are no longer in the archive """
+    for name in set(old_order) - set(order):
+        path = os.path.join(vcsdir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        # tidy up any folders left empty:
+        parent = os.path.dirname(path)
+        while os.path.normpath(parent) != os.path.normpath(vcsdir) and os.path.isdir(parent) and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+
+
+class Stats:
+    """
+    Records, for each member converted, the converter used, the size of its input and output, and the time spent
+    reading its input, converting it, and writing its output. To use, set Converter.stats = Stats(). Sub-members (e.g.
+    those in DataMashup) are recorded too, named e.g. 'DataMashup/Formulas/Section1.m', and every figure for the
+    member containing them (its output size, and read, convert and write times) includes all of theirs - other than
+    nested output, which the containing member then writes out itself (e.g. the sections zipped up in to DataMashup
+    when compressing), so it's only counted once.
+    """
+
+    def __init__(self):
+        self.members = []
+        self._current = []
+
+    @contextlib.contextmanager
+    def member(self, name, conv, in_size=None):
+        if self._current:
+            name = self._current[-1]['name'] + '/' + name
+        record = {'name': name, 'converter': type(conv).__name__, 'depth': len(self._current),
+                  'in_size': in_size or 0, 'out_size': 0, 'read': 0.0, 'convert': 0.0, 'write': 0.0}
+        self.members.append(record)
+        self._current.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self._current.pop()
+            record['convert'] = max(0.0, time.perf_counter() - start - record['read'] - record['write'])
+
+    def add(self, key, value, nested=False):
+        """
+        Add to the given field of the member currently being converted (if any), and of those containing it - unless
+        nested, in which case it's only added to the current member
+        """
+        for record in self._current[-1:] if nested else self._current:
+            record[key] += value
+
+    def extend(self, members):
+        """ Add the records from (e.g.) another process """
+        self.members.extend(members)
+
+    def by_converter(self):
+        """ Totals of the (top level) members for each converter """
+        totals = {}
+        for record in self.members:
+            if record['depth'] == 0:
+                total = totals.setdefault(record['converter'], {'members': 0, 'in_size': 0, 'out_size': 0,
+                                                                'read': 0.0, 'convert': 0.0, 'write': 0.0})
+                total['members'] += 1
+                for key in ('in_size', 'out_size', 'read', 'convert', 'write'):
+                    total[key] += record[key]
+        return totals
+
+    def to_dict(self):
+        return {'members': self.members, 'converters': self.by_converter()}
+
+    def _slowest_first(self):
+        """ The records, slowest first - with each member's sub-members (again slowest first) straight after it """
+        roots = []
+        stack = []  # [(record, its children)] for the member we're in and those containing it
+        for record in self.members:
+            while len(stack) > record['depth']:
+                stack.pop()
+            children = []
+            (stack[-1][1] if stack else roots).append((record, children))
+            stack.append((record, children))
+
+        def flatten(nodes):
+            for record, children in sorted(nodes, key=lambda n: -(n[0]['read'] + n[0]['convert'] + n[0]['write'])):
+                yield record
+                yield from flatten(children)
+
+        return list(flatten(roots))
+
+    def summary(self, outio):
+        row = '{0:60} {1:20} {2:>10} {3:>10} {4:>8} {5:>8} {6:>8}'
+        print(row.format('member', 'converter', 'in', 'out', 'read', 'convert', 'write'), file=outio)
+        for record in self._slowest_first():
+            print(row.format(('  ' * record['depth'] + record['name'])[:60], record['converter'], record['in_size'],
+                             record['out_size'], *('{0:.3f}'.format(record[k]) for k in ('read', 'convert', 'write'))),
+                  file=outio)
+        print(file=outio)
+        for conv, total in sorted(self.by_converter().items(), key=lambda kv: -kv[1]['convert']):
+            print(row.format('({0} members)'.format(total['members']), conv, total['in_size'], total['out_size'],
+                             *('{0:.3f}'.format(total[k]) for k in ('read', 'convert', 'write'))), file=outio)
+
+
+class StatsReader:
+    """ Wraps a readable stream, recording the time spent reading it in Converter.stats """
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, n=-1):
+        start = time.perf_counter()
+        b = self.f.read(n)
+        Converter.stats.add('read', time.perf_counter() - start)
+        return b
+
+
+class StatsWriter:
+    """
+    Wraps a writable stream, recording the time spent writing, and the amount written, in Converter.stats (only against
+    the current member if nested - see Stats.add)
+    """
+
+    def __init__(self, f, nested=False):
+        self.f = f
+        self.nested = nested
+
+    def write(self, b):
+        start = time.perf_counter()
+        n = self.f.write(b)
+        Converter.stats.add('write', time.perf_counter() - start, self.nested)
+        Converter.stats.add('out_size', len(b), self.nested)
+        return n
+
+
+def stats_reader(f):
+    return f if Converter.stats is None or isinstance(f, StatsReader) else StatsReader(f)
+
+
+def stats_writer(f, nested=False):
+    # (nested members may write through their parent's writer, so make sure we only count once)
+    return f if Converter.stats is None or isinstance(f, StatsWriter) else StatsWriter(f, nested)
 
 
 class Converter:
 
+    stats = None  # set to a Stats to record every conversion
+    keep_manifests = False  # see keeping_manifests
+
+    VERSION = 1  # bump this when a converter's output changes, so that any cached output is invalidated
+    VCS_FOLDER = False  # whether the vcs form is a folder (of files) rather than a single file
+
+    def measure(self, name, in_size=None):
+        """ A context manager which records (in Converter.stats, if set) the conversion of the member name within it """
+        if Converter.stats is None:
+            return contextlib.nullcontext()
+        return Converter.stats.member(name, self, in_size)
+
+    def cache_id(self):
+        """ Identifies this converter (and its settings) when caching its output """
+        return '{0}/{1}/{2!r}'.format(type(self).__name__, self.VERSION, sorted(vars(self).items()))
+
     def raw_to_vcs(self, b, *args, **kwargs):
         raise NotImplementedError("Converter.raw_to_vcs must be extended!")
 
@@ -21,9 +493,11 @@ class Converter:
         return self.raw_to_vcs(b, *args, **kwargs).decode('utf-8')
 
     def write_raw_to_vcs(self, b, vcspath, *args, **kwargs):
-        os.makedirs(os.path.dirname(vcspath), exist_ok=True)
-        with open(vcspath, 'wb') as f:
-            f.write(self.raw_to_vcs(b, *args, **kwargs))
+        write_if_changed(vcspath, self.raw_to_vcs(b, *args, **kwargs))
+
+    def write_rawstream_to_vcs(self, rawf, vcspath, *args, **kwargs):
+        # Override this (and write_rawstream_to_textconv) to avoid reading the whole member in to memory
+        self.write_raw_to_vcs(rawf.read(), vcspath, *args, **kwargs)
 
     def write_vcs_to_raw(self, vcspath, rawzip, *args, **kwargs):
         with open(vcspath, 'rb') as f:
@@ -32,6 +506,20 @@ class Converter:
     def write_raw_to_textconv(self, b, outio, *args, **kwargs):
         print(self.raw_to_textconv(b, *args, **kwargs), file=outio)
 
+    def write_rawstream_to_textconv(self, rawf, outio, *args, **kwargs):
+        self.write_raw_to_textconv(rawf.read(), outio, *args, **kwargs)
+
+    def raw_to_vcs_files(self, b):
+        """
+        The vcs form of raw b, built in memory rather than written out, as {path: bytes} - paths being relative to the
+        member's vcs path, with '' for the member itself. Override this for converters which write a folder.
+        """
+        return {'': self.raw_to_vcs(b)}
+
+    def write_vcs_files_to_raw(self, files, rawzip):
+        """ Undo raw_to_vcs_files, writing the raw form to rawzip """
+        rawzip.write(self.vcs_to_raw(files['']))
+
 class NoopConverter(Converter):
 
     def raw_to_vcs(self, b):
@@ -41,11 +529,19 @@ class NoopConverter(Converter):
         return b
 
     def raw_to_textconv(self, b, *args, **kwargs):
-        import hashlib
-        my_SHA256 = hashlib.sha256()
-        my_SHA256.update(b)
+        return "File hash: " + hash_bytes(b) + "\n"
+
+    def write_rawstream_to_vcs(self, rawf, vcspath):
+        """ Copy straight across, a chunk at a time """
+        with ChangedFileWriter(vcspath) as f:
+            shutil.copyfileobj(rawf, f, CHUNK_SIZE)
+
+    def write_vcs_to_raw(self, vcspath, rawzip):
+        with open(vcspath, 'rb') as f:
+            shutil.copyfileobj(f, rawzip, CHUNK_SIZE)
 
-        return "File hash: " + my_SHA256.hexdigest() + "\n"
+    def write_rawstream_to_textconv(self, rawf, outio):
+        print("File hash: " + hash_stream(rawf) + "\n", file=outio)
 
 class XMLConverter(Converter):
 
@@ -63,8 +559,10 @@ class XMLConverter(Converter):
 
     def raw_to_vcs(self, b):
         """ Convert xml from the raw pbit to onse suitable for version control - i.e. nicer encoding, pretty print, etc. """
+        from lxml import etree
 
         parser = etree.XMLParser(remove_blank_text=True)
+        b = bytes(b)  # lxml won't take e.g. a memoryview (and this is free if b is already bytes)
 
         # If no encoding is specified in the XML, all is well - we can decode it then pass the unicode to the parser.
         # However, if encoding is specified, then lxml won't accept an already decoded string - so we have to pass it
@@ -83,6 +581,7 @@ class XMLConverter(Converter):
 
     def vcs_to_raw(self, b):
         """ Convert from the csv version on xml to the raw form - i.e. not pretty printing and getting the encoding right """
+        from lxml import etree
 
         parser = etree.XMLParser(remove_blank_text=True)
         root = etree.fromstring(b, parser) # note that vcs is always in UTF-8, which is encoded in the xml, so no need to specify
@@ -99,6 +598,15 @@ class JSONConverter(Converter):
     def __init__(self, encoding):
         self.encoding = encoding
 
+    def _expand_embedded_json(self, s):
+        try:
+            d = json_loads(s)
+        except Exception:
+            return s
+        if isinstance(d, (dict, list)):
+            return {self.EMBEDDED_JSON_KEY: d}
+        return s
+
     def _jsonify_embedded_json(self, v):
         """
         Some pbit json has embedded json strings. To aid readability and diffs etc., we make sure we load and format
@@ -113,22 +621,25 @@ class JSONConverter(Converter):
         ```
         x: { EMBEDDED_JSON_KEY: { "y": 1 } }
         ```
+
+        Nearly all strings are just labels etc., so only those which look like an object/array are actually parsed.
+        v is walked without recursion and modified in place (so nothing is copied), and returned.
         """
         if isinstance(v, str):
-            try:
-                d = json.loads(v)
-                if isinstance(d, (dict, list)):
-                    return {self.EMBEDDED_JSON_KEY: d}
-                else:
-                    return v
-            except Exception as e:
-                return v
-        elif isinstance(v, dict):
-            return {kk: self._jsonify_embedded_json(vv) for kk, vv in v.items()}
-        elif isinstance(v, list):
-            return [self._jsonify_embedded_json(vv) for vv in v]
-        else:
-            return v
+            return self._expand_embedded_json(v) if could_be_json_container(v) else v
+        stack = [v] if isinstance(v, (dict, list)) else []
+        while stack:
+            container = stack.pop()
+            for k, vv in (container.items() if isinstance(container, dict) else enumerate(container)):
+                if isinstance(vv, str):
+                    if could_be_json_container(vv):
+                        container[k] = self._expand_embedded_json(vv)
+                elif isinstance(vv, (dict, list)):
+                    stack.append(vv)
+        return v
+
+    def _collapse_embedded_json(self, v):
+        return json.dumps(v[self.EMBEDDED_JSON_KEY], separators=(',', ':'), ensure_ascii=False, sort_keys=self.SORT_KEYS)
 
     def _undo_jsonify_embedded_json(self, v):
         """
@@ -143,70 +654,234 @@ class JSONConverter(Converter):
         ```
         x: "{\"y\": 1 }"
         ```
+
+        Again, v is walked without recursion and modified in place.
         """
-        if isinstance(v, dict):
-            if len(v) == 1 and self.EMBEDDED_JSON_KEY in v:
-                return json.dumps(v[self.EMBEDDED_JSON_KEY], separators=(',', ':'), ensure_ascii=False, sort_keys=self.SORT_KEYS)
-            return {kk: self._undo_jsonify_embedded_json(vv) for kk, vv in v.items()}
-        elif isinstance(v, list):
-            return [self._undo_jsonify_embedded_json(vv) for vv in v]
-        else:
-            return v
+        if isinstance(v, dict) and len(v) == 1 and self.EMBEDDED_JSON_KEY in v:
+            return self._collapse_embedded_json(v)
+        stack = [v] if isinstance(v, (dict, list)) else []
+        while stack:
+            container = stack.pop()
+            for k, vv in (container.items() if isinstance(container, dict) else enumerate(container)):
+                if isinstance(vv, dict):
+                    if len(vv) == 1 and self.EMBEDDED_JSON_KEY in vv:
+                        container[k] = self._collapse_embedded_json(vv)
+                    else:
+                        stack.append(vv)
+                elif isinstance(vv, list):
+                    stack.append(vv)
+        return v
+
+    def parse_raw(self, b):
+        """ Parse raw json from the pbit, expanding any embedded json (see _jsonify_embedded_json) """
+        return self._jsonify_embedded_json(json_loads(b.decode(self.encoding)))
 
     def raw_to_vcs(self, b):
         """ Converts raw json from pbit into that ready for vcs - mainly just prettification """
 
-        return json.dumps(self._jsonify_embedded_json(json.loads(b.decode(self.encoding))), indent=2,
+        return json.dumps(self.parse_raw(b), indent=2,
                           ensure_ascii=False,  # so embedded e.g. copyright symbols don't be munged to unicode codes
                           sort_keys=self.SORT_KEYS).encode('utf-8')
 
     def vcs_to_raw(self, b):
         """ Converts vcs json to that used in pbit - mainly just minification """
-        return json.dumps(self._undo_jsonify_embedded_json(json.loads(b.decode('utf-8'))), separators=(',', ':'), ensure_ascii=False, sort_keys=self.SORT_KEYS).encode(self.encoding)
+        return json.dumps(self._undo_jsonify_embedded_json(json_loads(b.decode('utf-8'))), separators=(',', ':'), ensure_ascii=False, sort_keys=self.SORT_KEYS).encode(self.encoding)
+
+    def write_raw_to_vcs(self, b, vcspath):
+        """ As raw_to_vcs, but serialised straight to vcspath rather than built up in memory first """
+        encoder = json.JSONEncoder(indent=2, ensure_ascii=False, sort_keys=self.SORT_KEYS)
+        with ChangedFileWriter(vcspath) as f:
+            write_text(encoder.iterencode(self.parse_raw(b)), f, 'utf-8')
+
+    def write_vcs_to_raw(self, vcspath, rawzip):
+        """ As vcs_to_raw, but encoded to rawzip a chunk at a time """
+        with open(vcspath, 'rb') as f:
+            self._write_raw_json(self._undo_jsonify_embedded_json(json_loads(f.read().decode('utf-8'))), rawzip)
+
+    def _write_raw_json(self, v, rawzip):
+        # (dumps is much quicker than iterencode here, as the C encoder is only used for one-shot compact encoding)
+        write_text(split_text(json.dumps(v, separators=(',', ':'), ensure_ascii=False, sort_keys=self.SORT_KEYS)),
+                   rawzip, self.encoding)
 
     def raw_to_textconv(self, b):
         """ Converts raw json from pbit into that ready for diffing - mainly just prettification """
 
-        return json.dumps(self._jsonify_embedded_json(json.loads(b.decode(self.encoding))), indent=2,
+        return json.dumps(self.parse_raw(b), indent=2,
                           ensure_ascii=False,  # so embedded e.g. copyright symbols don't be munged to unicode codes
                           sort_keys=True) + "\n"
 
+class ShardedLayoutConverter(JSONConverter):
+    """
+    Report/Layout, split in to a folder with a file per page (section) and per visual (visual container), so that
+    e.g. editing one visual only changes one small file:
+
+        layout.json                                     everything else, with "sections" as SHARDS_MARKER
+        .zo                                             the order of the sections (i.e. their folders), one per line
+        sections/<section>/section.json                 the section, with "visualContainers" as SHARDS_MARKER
+        sections/<section>/.zo                          the order of its visual containers
+        sections/<section>/visualContainers/<visual>.json
+
+    Sections and visual containers are named after their 'name' (falling back to their position if they don't have a
+    usable, unique one), and it all reassembles in to exactly what JSONConverter would produce.
+    """
+
+    VCS_FOLDER = True
+    SHARDS_MARKER = '__powerbi-vcs-shards__'
+    UNSAFE_NAME_RE = re.compile('[^A-Za-z0-9_. -]')
+    MAX_NAME_LENGTH = 100
+
+    def _visual_name(self, vc):
+        config = vc.get('config')
+        if isinstance(config, dict):
+            config = config.get(self.EMBEDDED_JSON_KEY, config)
+        return config.get('name') if isinstance(config, dict) else None
+
+    def _shard_names(self, names):
+        """ Safe, unique (even on case-insensitive filesystems) file names for each of names """
+        used = set()
+        out = []
+        for i, name in enumerate(names):
+            safe = self.UNSAFE_NAME_RE.sub('_', name)[:self.MAX_NAME_LENGTH].strip() if isinstance(name, str) else ''
+            if not safe or safe.startswith('.') or safe.lower() in used:
+                safe = '_{0}'.format(i)
+                while safe.lower() in used:
+                    safe += '_'
+            used.add(safe.lower())
+            out.append(safe)
+        return out
+
+    def _shards(self, layout):
+        """ Yield (path, json value, or bytes for the order files) for each file of the sharded layout """
+        sections = layout.get('sections') if isinstance(layout, dict) else None
+        if not isinstance(sections, list) or not all(isinstance(section, dict) for section in sections):
+            # nothing to shard:
+            yield 'layout.json', layout
+            return
+        names = self._shard_names([section.get('name') for section in sections])
+        yield 'layout.json', {k: self.SHARDS_MARKER if k == 'sections' else v for k, v in layout.items()}
+        yield '.zo', "\n".join(names).encode('utf-8')
+        for name, section in zip(names, sections):
+            folder = 'sections/' + name + '/'
+            vcs = section.get('visualContainers')
+            if not isinstance(vcs, list) or not all(isinstance(vc, dict) for vc in vcs):
+                yield folder + 'section.json', section
+                continue
+            vc_names = self._shard_names([self._visual_name(vc) for vc in vcs])
+            yield folder + 'section.json', {k: self.SHARDS_MARKER if k == 'visualContainers' else v
+                                            for k, v in section.items()}
+            yield folder + '.zo', "\n".join(vc_names).encode('utf-8')
+            for vc_name, vc in zip(vc_names, vcs):
+                yield folder + 'visualContainers/' + vc_name + '.json', vc
+
+    def _assemble(self, read):
+        """ Undo _shards, with read(path) returning the bytes of each file """
+
+        def read_order(path):
+            return [name for name in read(path).decode('utf-8').split("\n") if name]
+
+        layout = json_loads(read('layout.json').decode('utf-8'))
+        if isinstance(layout, dict) and layout.get('sections') == self.SHARDS_MARKER:
+            sections = []
+            for name in read_order('.zo'):
+                folder = 'sections/' + name + '/'
+                section = json_loads(read(folder + 'section.json').decode('utf-8'))
+                if section.get('visualContainers') == self.SHARDS_MARKER:
+                    section['visualContainers'] = [
+                        json_loads(read(folder + 'visualContainers/' + vc_name + '.json').decode('utf-8'))
+                        for vc_name in read_order(folder + '.zo')]
+                sections.append(section)
+            layout['sections'] = sections
+        return self._undo_jsonify_embedded_json(layout)
+
+    def raw_to_vcs_files(self, b):
+        return {path: v if isinstance(v, bytes) else
+                json.dumps(v, indent=2, ensure_ascii=False, sort_keys=self.SORT_KEYS).encode('utf-8')
+                for path, v in self._shards(self.parse_raw(b))}
+
+    def write_raw_to_vcs(self, b, outdir):
+        """ Write each shard (only rewriting those which have changed), then remove any left over from before """
+        encoder = json.JSONEncoder(indent=2, ensure_ascii=False, sort_keys=self.SORT_KEYS)
+        written = set()
+        for path, v in self._shards(self.parse_raw(b)):
+            outpath = os.path.join(outdir, *path.split('/'))
+            if isinstance(v, bytes):
+                write_if_changed(outpath, v)
+            else:
+                with ChangedFileWriter(outpath) as f:
+                    write_text(encoder.iterencode(v), f, 'utf-8')
+            written.add(os.path.normpath(outpath))
+        for root, dirs, files in os.walk(outdir, topdown=False):
+            for name in files:
+                if os.path.normpath(os.path.join(root, name)) not in written:
+                    os.remove(os.path.join(root, name))
+            if root != outdir and not os.listdir(root):
+                os.rmdir(root)
+
+    def write_vcs_to_raw(self, vcspath, rawzip):
+        if not os.path.isdir(vcspath):
+            # (it wasn't extracted sharded)
+            return super().write_vcs_to_raw(vcspath, rawzip)
+
+        def read(path):
+            with open(os.path.join(vcspath, *path.split('/')), 'rb') as f:
+                return f.read()
+
+        self._write_raw_json(self._assemble(read), rawzip)
+
+    def write_vcs_files_to_raw(self, files, rawzip):
+        if '' in files:
+            return super().write_vcs_files_to_raw(files, rawzip)
+        self._write_raw_json(self._assemble(files.__getitem__), rawzip)
+
+
 class MetadataConverter(Converter):
+    """
+    The metadata is a small binary blob - mostly length-prefixed names - which is stored as its (ASCII) bytes repr,
+    split into lines by breaking after each \\xNN escape that's followed by a printable character (i.e. before most
+    names). A repr never contains a raw newline (they're escaped as \\n), so a newline is always safe to use as the
+    terminator, and parsing simply drops them again.
+    """
+
+    SPLIT_RE = re.compile(r'(\\x[0-9a-f]{2})(?=[^\\x])')
+    ESCAPE_RE = re.compile(rb'\\(x[0-9a-fA-F]{2}|[0-7]{1,3}|.)', re.DOTALL)
+    ESCAPES = {b'\\': b'\\', b"'": b"'", b'"': b'"', b'a': b'\a', b'b': b'\b', b'f': b'\f', b'n': b'\n',
+               b'r': b'\r', b't': b'\t', b'v': b'\v', b'\n': b''}
 
     def raw_to_vcs(self, b):
         """ The metadata is nearly readable anyway, but let's just split into multiple lines """
 
-        # repr it so bytes are displayed in ascii
-        s = repr(b)
+        # repr it so bytes are displayed in ascii, then split it nicely into line items:
+        return self.SPLIT_RE.sub('\\1\n', repr(bytes(b))).encode('ascii')
 
-        # now split it nicely into line items
-        if '\n' in s:
-            raise ValueError("TODO: '\n' is used as a terminator but already exists in string! Someone needs to write some code to dynamically pick the (possibly multi-byte) terminator ...")
-        splat = re.split('(\\\\x[0-9a-f]{2})([^\\\\x])', s)
-        out = ''
-        for i, spl in enumerate(splat):
-            if i % 3 == 2:
-                out += '\n'
-            out += spl
-        return out.encode('ascii')
+    def _unescape(self, m):
+        esc = m.group(1)
+        if esc[:1] == b'x':
+            return bytes([int(esc[1:], 16)])
+        if esc[:1].isdigit():
+            return bytes([int(esc, 8) & 0xff])
+        # (as in a Python literal, unrecognised escapes are left as they are)
+        return self.ESCAPES.get(esc, b'\\' + esc)
 
     def vcs_to_raw(self, b):
-        """ Undo the above prettification """
+        """ Undo the above prettification - i.e. parse the bytes literal, without needing a Python parser """
 
-        return ast.literal_eval(b.decode('ascii').replace('\n', ''))
+        s = b.replace(b'\r\n', b'').replace(b'\n', b'')
+        if len(s) < 3 or s[:1] != b'b' or s[1:2] not in (b"'", b'"') or s[-1:] != s[1:2]:
+            raise ValueError("Metadata should be a bytes literal, e.g. b'...'")
+        return self.ESCAPE_RE.sub(self._unescape, s[2:-1])
 
 
 class DataMashupConverter(Converter):
     """
     The DataMashup file is a bit funky. The format is (roughly):
         - 4 null bytes
-        - 4 bytes representing little-endian int for length of next zip
+        - 4 bytes representing little-endian unsigned int for length of next zip
         - bytes (of length above) as zip
-        - 4 bytes representing little-endian int for length of next xml
+        - 4 bytes representing little-endian unsigned int for length of next xml
         - utf-8-sig xml of above length
-        - 4 bytes representing little-endian int - which seems to be 34 more than the one two below:
+        - 4 bytes representing little-endian unsigned int - which seems to be 34 more than the one two below:
         - 4 null bytes
-        - 4 bytes representing little-endian int for length of next xml
+        - 4 bytes representing little-endian unsigned int for length of next xml
         - xml of this length
         - the four bytes 16 00 00 00
         - a zip End (!) Of Central Directory record (indicated by the bytes 50 4b 05 06)
@@ -223,128 +898,198 @@ class DataMashupConverter(Converter):
           metadata, since it seems harmless to transplant everything after the previously mentioned 16 00 00 00.
     """
 
+    VCS_FOLDER = True
     CONVERTERS = {
         '[Content_Types].xml': XMLConverter('utf-8-sig', True),
         'Config/Package.xml': XMLConverter('utf-8-sig', True),
         'Formulas/Section1.m': NoopConverter()
     }
 
+    XML_SECTIONS = (("XML Block 1", "3.xml"), ("XML Block 2", "6.xml"))
+
+    class Sections:
+        """
+        A single pass over the DataMashup header, indexing where each section is (as memoryview slices of the original
+        bytes - so nothing is copied until a section is actually needed): the nested zip as 'zip', the two xmls as
+        '3.xml' and '6.xml', and everything after them as '7.bytes'.
+        """
+
+        def __init__(self, b):
+            import struct
+
+            view = memoryview(b)
+            if len(view) < 8 or view[:4] != b'\x00\x00\x00\x00':
+                raise ValueError("DataMashup doesn't start with 4 null bytes")
+            pos = 4
+            self.sections = {}
+
+            def take(name, length):
+                nonlocal pos
+                if length > len(view) - pos:
+                    raise ValueError("DataMashup section {0} ({1} bytes) runs past the end".format(name, length))
+                self.sections[name] = view[pos:pos + length]
+                pos += length
+
+            def uint32():
+                # (lengths are unsigned, so e.g. a corrupt length can't be negative and go backwards)
+                nonlocal pos
+                if pos + 4 > len(view):
+                    raise ValueError("DataMashup is truncated")
+                i, = struct.unpack_from("<I", view, pos)
+                pos += 4
+                return i
+
+            take('zip', uint32())
+            take('3.xml', uint32())
+            len_plus_34 = uint32()
+            if uint32() != 0:
+                raise ValueError("DataMashup is missing the 4 null bytes before the second xml")
+            len3 = uint32()
+            if len_plus_34 - len3 != 34:
+                raise ValueError("DataMashup has an unexpected length before the second xml")
+            take('6.xml', len3)
+            take('7.bytes', len(view) - pos)
+
+        def __getitem__(self, name):
+            return self.sections[name]
+
+        def open_zip(self):
+            import zipfile
+
+            return zipfile.ZipFile(MemoryViewReader(self.sections['zip']))
+
     def write_raw_to_vcs(self, b, outdir):
         """ Convert the raw format into multiple separate files that are more readable """
 
-        if b[:4] != b'\x00\x00\x00\x00':
-            raise ValueError("TODO")
-        len1 = int.from_bytes(b[4:8], byteorder="little")
-        start1 = 8
-        end1 = start1 + len1
-        zip1 = b[start1:end1]
-        start2 = end1 + 4
-        len2 = int.from_bytes(b[end1:start2], byteorder="little")
-        end2 = start2 + len2
-        xml1 = b[start2:end2]
-        b8 = b[end2:end2+8]
-        start3 = end2 + 12
-        len3 = int.from_bytes(b[end2 + 8: start3], byteorder="little")
-        if int.from_bytes(b[end2:end2+4], "little") - len3 != 34:
-            raise ValueError("TODO")
-        end3 = start3 + len3
-        xml2 = b[start3:end3]
-        extra = b[end3:]
+        sections = self.Sections(b)
+
+        # for incremental extracts, anything whose raw bytes (and converter) and output are unchanged since the last
+        # one is skipped:
+        keep_manifest = Converter.keep_manifests
+        old_manifest = read_manifest(outdir) if keep_manifest else {}
+        old_order = read_order(outdir)
+        manifest = []
+
+        def write_section(conv, raw, name):
+            h = hash_bytes(raw) if keep_manifest else None
+            convname = type(conv).__name__
+            outfile = os.path.join(outdir, name)
+            if not is_unchanged(old_manifest, name, h, convname, outfile):
+                with conv.measure(name, len(raw)):
+                    conv.write_raw_to_vcs(raw, outfile)
+            if keep_manifest:
+                manifest.append((name, h, hash_vcs(outfile), convname))
 
         # extract header zip:
-        with zipfile.ZipFile(BytesIO(zip1)) as zd:
+        with sections.open_zip() as zd:
             order = []
             # read items (in the order they appear in the archive)
             for name in zd.namelist():
                 order.append(name)
-                outfile = os.path.join(outdir, name)
-                os.makedirs(os.path.dirname(outfile), exist_ok=True) # create folder if needed
-                conv = self.CONVERTERS[name]
-                conv.write_raw_to_vcs(zd.read(name), outfile)
+                write_section(self.CONVERTERS[name], zd.read(name), name)
+
+        remove_stale(outdir, old_order, order)
 
         # write order:
-        open(os.path.join(outdir, ".zo"), 'w').write("\n".join(order))
+        write_if_changed(os.path.join(outdir, ".zo"), "\n".join(order).encode('utf-8'), stats=False)
 
-        # now write the xmls and bytes between:
-        # open(os.path.join(outdir, 'DataMashup', "1.int"), 'wb').write(b[4:8])
-        XMLConverter('utf-8-sig', True).write_raw_to_vcs(xml1, os.path.join(outdir, "3.xml"))
-        XMLConverter('utf-8-sig', True).write_raw_to_vcs(xml2, os.path.join(outdir, "6.xml"))
-        NoopConverter().write_raw_to_vcs(extra, os.path.join(outdir, "7.bytes"))
+        # now write the xmls and bytes between (only copied out of b if they've changed):
+        for title, name in self.XML_SECTIONS:
+            write_section(XMLConverter('utf-8-sig', True), sections[name], name)
+        write_section(NoopConverter(), sections['7.bytes'], "7.bytes")
+
+        if keep_manifest:
+            write_manifest(outdir, manifest)
 
     def write_vcs_to_raw(self, vcs_dir, rawzip):
 
-        # zip up the header bytes:
+        def write_section(conv, name, out):
+            # (out is either the inner zip or a buffer, which we write to rawzip ourselves, or rawzip itself - which is
+            # already counted as ours)
+            vcspath = os.path.join(vcs_dir, name)
+            with conv.measure(name, os.path.getsize(vcspath)):
+                conv.write_vcs_to_raw(vcspath, stats_writer(out, nested=True))
+
+        with open(os.path.join(vcs_dir, ".zo")) as f:
+            order = f.read().split("\n")
+        self._write_raw(order, write_section, rawzip)
+
+    def raw_to_vcs_files(self, b):
+        sections = self.Sections(b)
+        files = {}
+        with sections.open_zip() as zd:
+            order = zd.namelist()
+            for name in order:
+                files[name] = self.CONVERTERS[name].raw_to_vcs(zd.read(name))
+        files[".zo"] = "\n".join(order).encode('utf-8')
+        conv = XMLConverter('utf-8-sig', True)
+        for title, name in self.XML_SECTIONS:
+            files[name] = conv.raw_to_vcs(sections[name])
+        files["7.bytes"] = bytes(sections["7.bytes"])
+        return files
+
+    def write_vcs_files_to_raw(self, files, rawzip):
+
+        def write_section(conv, name, out):
+            conv.write_vcs_files_to_raw({'': files[name]}, out)
+
+        self._write_raw(files[".zo"].decode('utf-8').split("\n"), write_section, rawzip)
+
+    def _write_raw(self, order, write_section, rawzip):
+        """ Write the raw format to rawzip, with write_section(conv, name, out) writing the raw bytes of each section """
+        import struct
+        import zipfile
+
+        # zip up the header bytes (its length has to be written before it, so it can't be streamed straight out):
         b = BytesIO()
         with zipfile.ZipFile(b, mode='w', compression=zipfile.ZIP_DEFLATED) as zd:
-            order = open(os.path.join(vcs_dir, ".zo")).read().split("\n")
             for name in order:
-                conv = self.CONVERTERS[name]
                 with zd.open(name, 'w') as z:
-                    conv.write_vcs_to_raw(os.path.join(vcs_dir, name), z)
+                    write_section(self.CONVERTERS[name], name, z)
 
         # write header
         rawzip.write(b'\x00\x00\x00\x00')
 
-        # write zip
-        rawzip.write(struct.pack("<i", b.tell()))
-        b.seek(0)
-        rawzip.write(b.read())
-
-        # write first xml:
-
-        xmlb = XMLConverter('utf-8-sig', True).vcs_to_raw(open(os.path.join(vcs_dir, "3.xml"), 'rb').read())
-        rawzip.write(struct.pack("<i", len(xmlb)))
-        rawzip.write(xmlb)
-
-        # write second xml:
-        xmlb = XMLConverter('utf-8-sig', True).vcs_to_raw(open(os.path.join(vcs_dir, "6.xml"), 'rb').read())
-        rawzip.write(struct.pack("<i", len(xmlb) + 34))
-        rawzip.write(b'\x00\x00\x00\x00')
-        rawzip.write(struct.pack("<i", len(xmlb)))
-        rawzip.write(xmlb)
+        # write zip (straight from the buffer, rather than copying it out first):
+        rawzip.write(struct.pack("<I", b.tell()))
+        with b.getbuffer() as view:
+            rawzip.write(view)
+
+        # write the xmls:
+        conv = XMLConverter('utf-8-sig', True)
+        for i, (title, name) in enumerate(self.XML_SECTIONS):
+            out = BytesIO()
+            write_section(conv, name, out)
+            xmlb = out.getvalue()
+            if i == 1:
+                rawzip.write(struct.pack("<I", len(xmlb) + 34))
+                rawzip.write(b'\x00\x00\x00\x00')
+            rawzip.write(struct.pack("<I", len(xmlb)))
+            rawzip.write(xmlb)
 
         # write the rest:
-        NoopConverter().write_vcs_to_raw(os.path.join(vcs_dir, "7.bytes"), rawzip)
-
+        write_section(NoopConverter(), "7.bytes", rawzip)
 
     def write_raw_to_textconv(self, b, outio):
         """ Convert the raw format into readable text for comparison"""
 
-        if b[:4] != b'\x00\x00\x00\x00':
-            raise ValueError("TODO")
-        len1 = int.from_bytes(b[4:8], byteorder="little")
-        start1 = 8
-        end1 = start1 + len1
-        zip1 = b[start1:end1]
-        start2 = end1 + 4
-        len2 = int.from_bytes(b[end1:start2], byteorder="little")
-        end2 = start2 + len2
-        xml1 = b[start2:end2]
-        b8 = b[end2:end2+8]
-        start3 = end2 + 12
-        len3 = int.from_bytes(b[end2 + 8: start3], byteorder="little")
-        if int.from_bytes(b[end2:end2+4], "little") - len3 != 34:
-            raise ValueError("TODO")
-        end3 = start3 + len3
-        xml2 = b[start3:end3]
-        extra = b[end3:]
+        sections = self.Sections(b)
 
         # extract header zip:
-        with zipfile.ZipFile(BytesIO(zip1)) as zd:
-            order = []
+        with sections.open_zip() as zd:
             # read items (in the order they appear in the archive)
             for name in zd.namelist():
-                order.append(name)
                 print("Filename: " + name, file=outio)
                 conv = self.CONVERTERS[name]
-                conv.write_raw_to_textconv(zd.read(name), outio)
+                raw = zd.read(name)
+                with conv.measure(name, len(raw)):
+                    conv.write_raw_to_textconv(raw, stats_writer(outio))
 
         # now write the xmls and bytes between:
-        # open(os.path.join(outdir, 'DataMashup', "1.int"), 'wb').write(b[4:8])
-        print("DataMashup -> XML Block 1", file=outio)
-        XMLConverter('utf-8-sig', True).write_raw_to_textconv(xml1, outio)
-        print("DataMashup -> XML Block 2", file=outio)
-        XMLConverter('utf-8-sig', True).write_raw_to_textconv(xml2, outio)
-        print("DataMashup -> Extra Content", file=outio)
-        NoopConverter().write_raw_to_textconv(extra, outio)
+        for title, conv, name in [(title, XMLConverter('utf-8-sig', True), name) for title, name in self.XML_SECTIONS] + \
+                                 [("Extra Content", NoopConverter(), "7.bytes")]:
+            print("DataMashup -> " + title, file=outio)
+            raw = sections[name]
+            with conv.measure(name, len(raw)):
+                conv.write_raw_to_textconv(raw, stats_writer(outio))
         print(file=outio)
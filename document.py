@@ -0,0 +1,158 @@
+"""
+A library API for working with a pbit without going through the filesystem, e.g. for services inspecting lots of
+reports:
+
+    with PbitDocument(b) as doc:  # a path, bytes or (seekable) file object
+        layout = doc.vcs('Report/Layout')  # only this member is decompressed and converted
+        doc.write(DictSink())  # or DirectorySink(path) or ZipSink(path or file object)
+
+Opening a document only reads the zip's central directory. Each member is decompressed and converted the first time
+it's asked for (and kept), using the same converters as extracting to a folder would, so a document written to a
+DirectorySink is exactly what pbivcs -x would have extracted (less the hash manifests, which only speed up incremental
+extracts).
+"""
+
+import os
+import shutil
+import zipfile
+from io import StringIO
+
+import converters
+from pbivcs import find_converter
+
+
+class Sink:
+    """ Somewhere to write the files of an extracted pbit: override write(path, b), with path '/' separated """
+
+    def write(self, path, b):
+        raise NotImplementedError("Sink.write must be extended!")
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DictSink(Sink):
+    """ Keep the files in memory, in .files, as {path: bytes} """
+
+    def __init__(self):
+        self.files = {}
+
+    def write(self, path, b):
+        self.files[path] = bytes(b)
+
+
+class DirectorySink(Sink):
+    """ Write the files under path (as extract_pbit would), which mustn't already exist unless overwrite """
+
+    def __init__(self, path, overwrite=False):
+        if os.path.exists(path):
+            if overwrite:
+                shutil.rmtree(path)
+            else:
+                raise Exception('Output path "{0}" already exists'.format(path))
+        self.path = path
+
+    def write(self, path, b):
+        outpath = os.path.join(self.path, *path.split('/'))
+        os.makedirs(os.path.dirname(outpath), exist_ok=True)
+        with open(outpath, 'wb') as f:
+            f.write(b)
+
+
+class ZipSink(Sink):
+    """ Write the files to a zip at file (a path or file object) """
+
+    def __init__(self, file, compression=zipfile.ZIP_DEFLATED):
+        self.zd = zipfile.ZipFile(file, 'w', compression=compression)
+
+    def write(self, path, b):
+        self.zd.writestr(path, b)
+
+    def close(self):
+        self.zd.close()
+
+
+class PbitDocument:
+    """
+    A pbit opened from source - a path, bytes(-like) or file object - with its members indexed from the zip's central
+    directory, and only decompressed (raw) and converted (vcs, text) when first asked for. With shard_layout, the vcs
+    form of Report/Layout is a file per page and visual, as with pbivcs --shard-layout.
+    """
+
+    def __init__(self, source, shard_layout=False):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = converters.MemoryViewReader(source)
+        self.zd = zipfile.ZipFile(source)
+        self.names = self.zd.namelist()
+        self.shard_layout = shard_layout
+        self._raw = {}
+        self._vcs = {}
+
+    def close(self):
+        self.zd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def info(self, name):
+        """ The ZipInfo of member name (its sizes, CRC etc.), which doesn't need it to be decompressed """
+        return self.zd.getinfo(name)
+
+    def converter(self, name):
+        return find_converter(name, self.shard_layout)
+
+    def raw(self, name):
+        """ The raw (decompressed) bytes of member name """
+        if name not in self._raw:
+            self._raw[name] = self.zd.read(name)
+        return self._raw[name]
+
+    def vcs(self, name):
+        """
+        The vcs form of member name as {path: bytes}, paths being relative to the member (so '' for the member itself,
+        or e.g. '3.xml' for DataMashup)
+        """
+        if name not in self._vcs:
+            conv = self.converter(name)
+            raw = self.raw(name)
+            with conv.measure(name, len(raw)):
+                self._vcs[name] = conv.raw_to_vcs_files(raw)
+        return self._vcs[name]
+
+    def text(self, name):
+        """ The textconv form of member name """
+        out = StringIO()
+        conv = self.converter(name)
+        raw = self.raw(name)
+        with conv.measure(name, len(raw)):
+            conv.write_raw_to_textconv(raw, converters.stats_writer(out))
+        return out.getvalue()
+
+    def release(self, name):
+        """ Forget the raw and vcs forms of member name (e.g. once they've been written somewhere), to free memory """
+        self._raw.pop(name, None)
+        self._vcs.pop(name, None)
+
+    def write(self, sink):
+        """ Write the vcs form of every member (and the order file) to sink """
+        for name in self.names:
+            for path, b in self.vcs(name).items():
+                sink.write(name + '/' + path if path else name, b)
+        sink.write('.zo', "\n".join(self.names).encode('utf-8'))
+
+    def save(self, file):
+        """ Compress the vcs form of every member back in to a pbit at file (a path or file object) """
+        with zipfile.ZipFile(file, mode='w', compression=zipfile.ZIP_DEFLATED) as zd:
+            for name in self.names:
+                conv = self.converter(name)
+                with conv.measure(name), zd.open(name, 'w') as z:
+                    conv.write_vcs_files_to_raw(self.vcs(name), converters.stats_writer(z))
@@ -0,0 +1,176 @@
+"""
+Support for git's long-running filter process protocol (see "Long Running Filter Process" in gitattributes(5)), so that
+a single warm pbivcs process can clean/smudge every *.pbit in a git operation, rather than starting a new one per file.
+
+Since a filter has to map one file to one file, the cleaned form of a *.pbit is its extracted VCS folder flattened into
+a single text file (a bit like zippey): each file is introduced by a header line and its content follows, as text if
+possible, else as base64. This stays diffable (and mostly mergeable) line by line.
+"""
+
+import base64
+import os
+import sys
+
+import converters
+
+MAX_PACKET_DATA = 65516
+FILE_HEADER = '@@@pbivcs-file '
+SKIP_FILES = (converters.MANIFEST_FILE,)  # the hash manifests are just a cache for incremental extracts
+
+
+def read_pkt_line(f):
+    """ Read one pkt-line, returning its payload, or None for a flush packet """
+    header = f.read(4)
+    if len(header) < 4:
+        raise EOFError("Unexpected end of pkt-line stream")
+    n = int(header, 16)
+    if n == 0:
+        return None
+    data = b''
+    while len(data) < n - 4:
+        chunk = f.read(n - 4 - len(data))
+        if not chunk:
+            raise EOFError("Unexpected end of pkt-line stream")
+        data += chunk
+    return data
+
+
+def read_pkt_list(f):
+    """ Read text pkt-lines up to the next flush """
+    lines = []
+    while True:
+        line = read_pkt_line(f)
+        if line is None:
+            return lines
+        lines.append(line.decode('utf-8').rstrip('\n'))
+
+
+def read_pkt_content(f):
+    """ Read binary pkt-lines up to the next flush """
+    chunks = []
+    while True:
+        chunk = read_pkt_line(f)
+        if chunk is None:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def write_pkt_line(f, b):
+    f.write(b'%04x' % (len(b) + 4))
+    f.write(b)
+
+
+def write_flush(f):
+    f.write(b'0000')
+
+
+def write_pkt_list(f, lines):
+    for line in lines:
+        write_pkt_line(f, (line + '\n').encode('utf-8'))
+    write_flush(f)
+
+
+def write_pkt_content(f, b):
+    for i in range(0, len(b), MAX_PACKET_DATA):
+        write_pkt_line(f, b[i:i + MAX_PACKET_DATA])
+    write_flush(f)
+
+
+def filter_process(commands, fin=None, fout=None, errio=sys.stderr):
+    """
+    Serve git's long-running filter process protocol on fin/fout (default stdin/stdout) until git closes the pipe.
+    commands maps each supported command (e.g. 'clean', 'smudge') to a function (content bytes, pathname) -> bytes.
+    """
+    fin = fin or sys.stdin.buffer
+    fout = fout or sys.stdout.buffer
+
+    # handshake:
+    welcome = read_pkt_list(fin)
+    if not welcome or welcome[0] != 'git-filter-client' or 'version=2' not in welcome[1:]:
+        raise ValueError("Unsupported filter protocol handshake: {0}".format(welcome))
+    write_pkt_list(fout, ['git-filter-server', 'version=2'])
+    capabilities = [c for c in read_pkt_list(fin) if c.split('=', 1)[-1] in commands]
+    write_pkt_list(fout, capabilities)
+    fout.flush()
+
+    while True:
+        try:
+            headers = read_pkt_list(fin)
+        except EOFError:
+            return
+        meta = dict(h.split('=', 1) for h in headers if '=' in h)
+        content = read_pkt_content(fin)
+        try:
+            out = commands[meta.get('command')](content, meta.get('pathname'))
+        except Exception as e:
+            print('pbivcs: failed to {0} "{1}": {2}: {3}'.format(meta.get('command'), meta.get('pathname'),
+                                                                 type(e).__name__, e), file=errio)
+            write_pkt_list(fout, ['status=error'])
+        else:
+            write_pkt_list(fout, ['status=success'])
+            write_pkt_content(fout, out)
+            write_pkt_list(fout, [])  # i.e. keep status=success
+        fout.flush()
+
+
+def flatten_dir(vcsdir):
+    """ Flatten the files in vcsdir into a single text file (as bytes) """
+    paths = []
+    for root, dirs, files in os.walk(vcsdir):
+        dirs.sort()
+        for name in sorted(files):
+            if name not in SKIP_FILES:
+                paths.append(os.path.relpath(os.path.join(root, name), vcsdir).replace(os.sep, '/'))
+
+    out = []
+    for relpath in paths:
+        with open(os.path.join(vcsdir, relpath), 'rb') as f:
+            b = f.read()
+        try:
+            s = b.decode('utf-8')
+            if any(line.startswith(FILE_HEADER) for line in s.split('\n')):
+                raise ValueError("Content clashes with the file header")
+        except ValueError:
+            # (UnicodeDecodeError is a ValueError too)
+            encoded = base64.encodebytes(b).decode('ascii')
+            out.append('{0}{1} base64\n{2}'.format(FILE_HEADER, relpath, encoded))
+        else:
+            if s.endswith('\n') or not s:
+                out.append('{0}{1} text\n{2}'.format(FILE_HEADER, relpath, s))
+            else:
+                out.append('{0}{1} text-noeol\n{2}\n'.format(FILE_HEADER, relpath, s))
+    return ''.join(out).encode('utf-8')
+
+
+def unflatten_to_dir(b, vcsdir):
+    """ Undo flatten_dir, writing the files out under vcsdir """
+    relpath = None
+    lines = []
+
+    def write():
+        content = ''.join(lines)
+        if kind == 'base64':
+            data = base64.decodebytes(content.encode('ascii'))
+        elif kind == 'text-noeol':
+            data = content[:-1].encode('utf-8')
+        else:
+            data = content.encode('utf-8')
+        path = os.path.join(vcsdir, *relpath.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    # (only split on '\n' - splitlines would also split on e.g. '\r' or '\x0c' in the content)
+    splat = b.decode('utf-8').split('\n')
+    for line in [l + '\n' for l in splat[:-1]] + ([splat[-1]] if splat[-1] else []):
+        if line.startswith(FILE_HEADER):
+            if relpath is not None:
+                write()
+            relpath, kind = line[len(FILE_HEADER):].rstrip('\n').rsplit(' ', 1)
+            lines = []
+        elif relpath is None:
+            raise ValueError("Expected a '{0}' line before any content".format(FILE_HEADER.strip()))
+        else:
+            lines.append(line)
+    if relpath is not None:
+        write()
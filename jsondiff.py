@@ -0,0 +1,142 @@
+"""
+A structural diff of two parsed json documents, for comparing e.g. two versions of a Report/Layout object by object
+rather than line by line. Lists of objects are matched up by a stable key where they have one (e.g. the name of a table
+or measure, or of a visual container - which lives in its embedded config), so inserting or reordering items doesn't
+show up as everything after them having changed. Other lists are matched up with difflib.
+"""
+
+import difflib
+import json
+
+from converters import JSONConverter
+
+EMBEDDED_JSON_KEY = JSONConverter.EMBEDDED_JSON_KEY
+MAX_VALUE_WIDTH = 100  # values longer than this are elided in the output, so a changed visual is one line, not a page
+
+
+def _embedded_config_name(item):
+    config = item.get('config')
+    if isinstance(config, dict):
+        config = config.get(EMBEDDED_JSON_KEY, config)
+    return config.get('name') if isinstance(config, dict) else None
+
+
+# (label, function) pairs for the keys list items can be matched by, in order of preference:
+LIST_KEYS = (
+    ('name', lambda item: item.get('name')),
+    ('name', _embedded_config_name),  # visual containers
+    ('id', lambda item: item.get('id')),
+)
+
+
+def _list_key(a, b):
+    """ Return the (label, function) of the first of LIST_KEYS that every item of a and b has a unique value for """
+    if not all(isinstance(item, dict) for item in a) or not all(isinstance(item, dict) for item in b):
+        return None
+    for label, fn in LIST_KEYS:
+        for items in (a, b):
+            keys = [fn(item) for item in items]
+            if not all(isinstance(k, (str, int)) for k in keys) or len(set(keys)) != len(keys):
+                break
+        else:
+            return label, fn
+    return None
+
+
+def _join(path, key):
+    if key == EMBEDDED_JSON_KEY:
+        return path
+    return '{0}.{1}'.format(path, key) if path else str(key)
+
+
+def _same(a, b):
+    """ Whether a and b are the same json - in which 1, 1.0 and True all differ, though python says they're equal """
+    # (== is quick and rules out nearly all differences, so only then walk them checking the types all match)
+    return a == b and _same_types(a, b)
+
+
+def _same_types(a, b):
+    """ Given a == b, whether every value in a has the same type as its counterpart in b """
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return all(_same_types(v, b[k]) for k, v in a.items())
+    if isinstance(a, list):
+        return all(_same_types(x, y) for x, y in zip(a, b))
+    return True
+
+
+def diff(a, b, path=''):
+    """
+    Yield (op, path, old, new) for each difference between the json values a and b, where op is '-' (removed), '+'
+    (added) or '~' (changed), and path is e.g. 'sections[name=ReportSection].visualContainers[name=abc].x'.
+    """
+    if isinstance(a, dict) and isinstance(b, dict):
+        for k, v in a.items():
+            if k not in b:
+                yield '-', _join(path, k), v, None
+            elif not _same(v, b[k]):
+                yield from diff(v, b[k], _join(path, k))
+        for k, v in b.items():
+            if k not in a:
+                yield '+', _join(path, k), None, v
+    elif isinstance(a, list) and isinstance(b, list):
+        yield from _diff_list(a, b, path)
+    elif not _same(a, b):
+        yield '~', path, a, b
+
+
+def _diff_list(a, b, path):
+    key = _list_key(a, b)
+    if key is not None:
+        label, fn = key
+        a_items = {fn(item): item for item in a}
+        b_items = {fn(item): item for item in b}
+        for k, item in a_items.items():
+            subpath = '{0}[{1}={2}]'.format(path, label, k)
+            if k not in b_items:
+                yield '-', subpath, item, None
+            elif not _same(item, b_items[k]):
+                yield from diff(item, b_items[k], subpath)
+        for k, item in b_items.items():
+            if k not in a_items:
+                yield '+', '{0}[{1}={2}]'.format(path, label, k), None, item
+        a_order = [k for k in a_items if k in b_items]
+        b_order = [k for k in b_items if k in a_items]
+        if a_order != b_order:
+            yield '~', '{0}[order]'.format(path), a_order, b_order
+        return
+
+    # otherwise, match up the items that are exactly the same:
+    matcher = difflib.SequenceMatcher(None, [_canonical(item) for item in a], [_canonical(item) for item in b],
+                                      autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            continue
+        if tag == 'replace' and i2 - i1 == j2 - j1:
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                yield from diff(a[i], b[j], '{0}[{1}]'.format(path, i))
+            continue
+        for i in range(i1, i2):
+            yield '-', '{0}[{1}]'.format(path, i), a[i], None
+        for j in range(j1, j2):
+            yield '+', '{0}[{1}]'.format(path, j), None, b[j]
+
+
+def _canonical(v):
+    return json.dumps(v, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def format_value(v):
+    s = json.dumps(v, separators=(',', ':'), ensure_ascii=False)
+    return s if len(s) <= MAX_VALUE_WIDTH else s[:MAX_VALUE_WIDTH - 3] + '...'
+
+
+def format_change(op, path, old, new):
+    """ A one line description of a change yielded by diff """
+    path = path or '(root)'
+    if op == '-':
+        return '- {0}: {1}'.format(path, format_value(old))
+    if op == '+':
+        return '+ {0}: {1}'.format(path, format_value(new))
+    return '~ {0}: {1} -> {2}'.format(path, format_value(old), format_value(new))
@@ -4,12 +4,18 @@
     # - checks that the .pbit.extract folder is up to date with the latest .pbit (i.e. they match exactly - and the .pbit hasn't been exported but user forgot to run the extract script)
     # - adds a warning (with y/n continue feedback) if the .pbix has been updated *after* the latest .pbit.extract is updated. (I.e. they maybe forgot to export the latest .pbit and extract, or exported .pbit but forgot to extract.) Note that this will be obvious in the case of only a single change (as it were) - since .pbix aren't tracked, they'll see no changes to git tracked files.
 
-import zipfile
+# (git runs us once per file, so startup time matters: anything that's not needed by every run - zipfile, process
+# pools, the watcher etc. - is imported where it's used instead, as are the converters' own dependencies)
 import os
 import shutil
 import sys
 import fnmatch
+import json
+import functools
+import stat
+from io import BytesIO, StringIO
 import converters
+from blobstore import BlobConverter, BlobStore, read_pointer
 
 
 CONVERTERS = [
@@ -27,9 +33,15 @@ CONVERTERS = [
     ('*.json', converters.JSONConverter('utf-8'))
 ]
 
+# used instead of the above with --shard-layout (or when compressing a member that was extracted that way):
+SHARDED_CONVERTERS = [
+    ('Report/Layout', converters.ShardedLayoutConverter('utf-16-le')),
+]
+
 
-def find_converter(path):
-    for pattern, converter in CONVERTERS:
+@functools.lru_cache(maxsize=None)
+def find_converter(path, shard_layout=False):
+    for pattern, converter in (SHARDED_CONVERTERS + CONVERTERS if shard_layout else CONVERTERS):
         if fnmatch.fnmatch(path, pattern):
             conv = converter
             break
@@ -38,41 +50,196 @@ def find_converter(path):
     return conv
 
 
-def extract_pbit(pbit_path, outdir, overwrite):
+def _vcs_converter(name, vcspath):
+    """ The converter for member name as extracted at vcspath - i.e. sharded if that's a folder """
+    return find_converter(name, os.path.isdir(vcspath))
+
+
+def _map_members(fn, items, jobs=None):
+    """
+    Yield fn(*item) for each item, in order. With jobs > 1 the calls are spread across a pool of that many worker
+    processes (reading all the items up front), otherwise items are consumed lazily one at a time.
     """
-    Convert a pbit to vcs format
+    if jobs and jobs > 1:
+        import concurrent.futures
+
+        items = list(items)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(_call_recording_stats, fn, converters.Converter.stats is not None, *item)
+                       for item in items]
+            for future in futures:
+                result, stats = future.result()
+                if stats:
+                    converters.Converter.stats.extend(stats)
+                yield result
+    else:
+        for item in items:
+            yield fn(*item)
+
+
+def _call_recording_stats(fn, record_stats, *args):
+    """ Call fn(*args) (in a worker process), returning its result and, if record_stats, the stats it recorded """
+    if not record_stats:
+        return fn(*args), None
+    converters.Converter.stats = converters.Stats()
+    try:
+        return fn(*args), converters.Converter.stats.members
+    finally:
+        converters.Converter.stats = None
+
+
+def _vcs_size(vcspath):
+    if os.path.isdir(vcspath):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(vcspath) for name in files)
+    return os.path.getsize(vcspath) if os.path.isfile(vcspath) else 0
+
+
+def _extract_member(name, b, outpath, shard_layout=False, incremental=False):
+    conv = find_converter(name, shard_layout)
+    with converters.keeping_manifests(incremental), conv.measure(name, len(b)):
+        conv.write_raw_to_vcs(b, outpath)
+
+
+def _compress_member(name, vcspath):
+    b = BytesIO()
+    conv = _vcs_converter(name, vcspath)
+    with conv.measure(name, _vcs_size(vcspath)):
+        conv.write_vcs_to_raw(vcspath, converters.stats_writer(b))
+    return b.getvalue()
+
+
+def _textconv_member(name, b):
+    outio = StringIO()
+    conv = find_converter(name)
+    with conv.measure(name, len(b)):
+        conv.write_raw_to_textconv(b, converters.stats_writer(outio))
+    return outio.getvalue()
+
+
+def extract_pbit(pbit_path, outdir, overwrite, incremental=False, jobs=None, raw_store=None, shard_layout=False,
+                 blob_store=None):
     """
+    Convert a pbit to vcs format. If incremental, an existing outdir is updated in place: members whose raw bytes
+    (and converter) match the hash manifest (.zh) from the last incremental extract - and whose output hasn't been
+    changed since - are skipped entirely, and only files whose converted output differs are rewritten. Only
+    incremental extracts write the manifest. If jobs > 1, members are converted across that many worker processes. If
+    a RawStore is given, the original compressed stream of each member is kept in it, for compress_pbit to reuse. If
+    shard_layout, Report/Layout is extracted to a folder of a file per page and visual (see ShardedLayoutConverter). If
+    a BlobStore is given, pass-through members of at least its min_size are streamed in to it, leaving just a pointer.
+    """
+    import zipfile
+
     # TODO: check ends in pbit
     # TODO: check all expected files are present (in the right order)
 
     # wipe output directory and create:
-    if os.path.exists(outdir):
+    if os.path.exists(outdir) and not incremental:
         if overwrite:
             shutil.rmtree(outdir)
         else:
             raise Exception('Output path "{0}" already exists'.format(outdir))
 
-    os.mkdir(outdir)
+    os.makedirs(outdir, exist_ok=True)
 
+    old_manifest = converters.read_manifest(outdir)
+    old_order = converters.read_order(outdir)
     order = []
+    raw_hashes = {}
+    vcs_hashes = {}
+    convs = {}
 
-    with zipfile.ZipFile(pbit_path, compression=zipfile.ZIP_DEFLATED) as zd:
+    with zipfile.ZipFile(pbit_path, compression=zipfile.ZIP_DEFLATED) as zd, converters.keeping_manifests(incremental):
 
+        pending = []
         # read items (in the order they appear in the archive)
         for name in zd.namelist():
             order.append(name)
             outpath = os.path.join(outdir, name)
             # get converter:
-            conv = find_converter(name)
-            # convert
-            conv.write_raw_to_vcs(zd.read(name), outpath)
+            conv = find_converter(name, shard_layout)
+            if (blob_store is not None and isinstance(conv, converters.NoopConverter)
+                    and zd.getinfo(name).file_size >= blob_store.min_size):
+                conv = BlobConverter(blob_store)
+            convs[name] = conv
+            convname = type(conv).__name__
+            if os.path.exists(outpath) and os.path.isdir(outpath) != conv.VCS_FOLDER:
+                # it was extracted differently (e.g. to a file rather than a folder, before --shard-layout was turned
+                # on), so start again - whether or not the manifest knows about it:
+                converters.remove_stale(outdir, [name], [])
+            if old_manifest.get(name, (None, None, None))[2] == convname and os.path.exists(outpath):
+                # skip it if it's unchanged (and so is what we extracted from it last time):
+                with zd.open(name) as f:
+                    h = converters.hash_stream(f)
+                if converters.is_unchanged(old_manifest, name, h, convname, outpath):
+                    raw_hashes[name], vcs_hashes[name] = h, old_manifest[name][1]
+                    continue
+            if jobs and jobs > 1 and not isinstance(conv, BlobConverter):
+                # convert in parallel below:
+                b = zd.read(name)
+                raw_hashes[name] = converters.hash_bytes(b)
+                pending.append((name, b, outpath, shard_layout, incremental))
+            else:
+                # convert, streaming from the archive where the converter supports it:
+                with conv.measure(name, zd.getinfo(name).file_size), zd.open(name) as f:
+                    rawf = converters.HashingReader(converters.stats_reader(f))
+                    conv.write_rawstream_to_vcs(rawf, outpath)
+                    raw_hashes[name] = rawf.hexdigest()
+
+        for _ in _map_members(_extract_member, pending, jobs):
+            pass
+
+        if incremental or raw_store is not None:
+            for name in order:
+                if name not in vcs_hashes:
+                    vcs_hashes[name] = converters.hash_vcs(os.path.join(outdir, name))
+
+        if raw_store is not None:
+            for name in order:
+                key = raw_store.key(vcs_hashes[name], convs[name])
+                if not raw_store.has(key):
+                    raw_store.put_from_zip(key, zd, name)
+
+        # remove anything left over from a previous extract:
+        converters.remove_stale(outdir, old_order, order)
+
+        # write order and (for the next incremental extract) hash files:
+        converters.write_if_changed(os.path.join(outdir, ".zo"), "\n".join(order).encode('utf-8'))
+        if incremental:
+            converters.write_manifest(outdir, [(name, raw_hashes[name], vcs_hashes[name], type(convs[name]).__name__)
+                                               for name in order])
 
-        # write order files:
-        open(os.path.join(outdir, ".zo"), 'w').write("\n".join(order))
+
+def _zipinfo(name, conv, compress_levels):
+    """
+    The ZipInfo to write member name with: compress_levels maps converter class names to a deflate level (0-9) or
+    'stored', and members of any other converter are deflated at the default level. Every member, whether converted or
+    copied from a RawStore, gets ZipInfo's default date (1980-01-01), so the same vcs folder always compresses to the
+    same pbit.
+    """
+    import zipfile
+
+    zinfo = zipfile.ZipInfo(name)
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    level = (compress_levels or {}).get(type(conv).__name__)
+    if level == 'stored':
+        zinfo.compress_type = zipfile.ZIP_STORED
+    else:
+        zinfo._compresslevel = level  # (no public way to set this before python 3.13, which still supports it)
+    return zinfo
 
 
-def compress_pbit(extracted_path, compressed_path, overwrite):
-    """Convert a vcs store to valid pbit."""
+def compress_pbit(extracted_path, compressed_path, overwrite, jobs=None, raw_store=None, compress_levels=None,
+                  blob_store=None):
+    """
+    Convert a vcs store to valid pbit. If jobs > 1, members are converted across that many worker processes. If a
+    RawStore is given, members whose vcs form is unchanged since they were extracted have their original compressed
+    stream copied straight across, rather than being converted and deflated again. compress_levels sets the
+    compression of the members of each converter class (see _zipinfo) - members of those classes are always
+    compressed afresh, rather than copied from raw_store. Members extracted to a BlobStore are streamed
+    back from blob_store.
+    """
+    import zipfile
+
     # TODO: check all paths exists
 
     if os.path.exists(compressed_path):
@@ -85,69 +252,541 @@ def compress_pbit(extracted_path, compressed_path, overwrite):
     with open(os.path.join(extracted_path, ".zo")) as f:
         order = f.read().split("\n")
 
+    # get converters:
+    convs = {}
+    for name in order:
+        vcspath = os.path.join(extracted_path, name)
+        if read_pointer(vcspath) is None:
+            convs[name] = _vcs_converter(name, vcspath)
+        elif blob_store is None:
+            raise Exception('"{0}" is a pointer to a blob, so needs a blob store to compress'.format(vcspath))
+        else:
+            convs[name] = BlobConverter(blob_store)
+
     with zipfile.ZipFile(compressed_path, mode='w',
                          compression=zipfile.ZIP_DEFLATED) as zd:
+        # find what's unchanged since extracting (other than members we've been asked to compress at a given level,
+        # as we don't know what level they were compressed at):
+        stored = {}
+        if raw_store is not None:
+            for name in order:
+                if type(convs[name]).__name__ in (compress_levels or {}):
+                    continue
+                key = raw_store.key(converters.hash_vcs(os.path.join(extracted_path, name)), convs[name])
+                if raw_store.has(key):
+                    stored[name] = key
+
+        raws = {}
+        if jobs and jobs > 1:
+            # convert in parallel (other than blobs, which are just copied), then zip up in the original order:
+            todo = [name for name in order if name not in stored and not isinstance(convs[name], BlobConverter)]
+            raws = dict(zip(todo, _map_members(_compress_member,
+                                               ((name, os.path.join(extracted_path, name)) for name in todo), jobs)))
+
         for name in order:
-            # get converter:
-            conv = find_converter(name)
-            # convert
-            with zd.open(name, 'w') as z:
-                conv.write_vcs_to_raw(os.path.join(extracted_path, name), z)
+            conv = convs[name]
+            vcspath = os.path.join(extracted_path, name)
+            zinfo = _zipinfo(name, conv, compress_levels)
+            if name in stored:
+                with conv.measure(name, _vcs_size(vcspath)):
+                    raw_store.copy_to_zip(stored[name], zd, zinfo)
+                continue
+            if name in raws:
+                with zd.open(zinfo, 'w') as z:
+                    z.write(raws[name])
+            else:
+                # convert
+                with conv.measure(name, _vcs_size(vcspath)), zd.open(zinfo, 'w') as z:
+                    conv.write_vcs_to_raw(vcspath, converters.stats_writer(z))
 
-def textconv_pbit(pbit_path, outio):
+def textconv_pbit(pbit_path, outio, jobs=None, cache=None):
     """
-    Convert a pbit to a text format suitable for diffing
+    Convert a pbit to a text format suitable for diffing. If jobs > 1, members are converted across that many worker
+    processes. If a TextconvCache is given, members which have been converted before are read from it instead.
     """
+    import zipfile
+
     # TODO: check ends in pbit
 
-    order = []
-    
     with zipfile.ZipFile(pbit_path, compression=zipfile.ZIP_DEFLATED, mode='r') as zd:
 
         # read items (in the order they appear in the archive)
-        for name in zd.namelist():
-            order.append(name)
+        names = zd.namelist()
+        texts = {}
+        keys = {}
+        if cache is not None:
+            for name in names:
+                with zd.open(name) as f:
+                    keys[name] = cache.key(converters.hash_stream(f), find_converter(name))
+                text = cache.get(keys[name])
+                if text is not None:
+                    texts[name] = text
+
+        if jobs and jobs > 1:
+            todo = [name for name in names if name not in texts]
+            for name, text in zip(todo, _map_members(_textconv_member, ((name, zd.read(name)) for name in todo), jobs)):
+                texts[name] = text
+                if cache is not None:
+                    cache.put(keys[name], text)
+
+        for name in names:
             print("Filename: " + name, file=outio)
+            if name in texts:
+                outio.write(texts[name])
+                continue
             # get converter:
             conv = find_converter(name)
             # convert
-            conv.write_raw_to_textconv(zd.read(name), outio)
+            out = outio if cache is None else StringIO()
+            with conv.measure(name, zd.getinfo(name).file_size), zd.open(name) as f:
+                conv.write_rawstream_to_textconv(converters.stats_reader(f), converters.stats_writer(out))
+            if cache is not None:
+                cache.put(keys[name], out.getvalue())
+                outio.write(out.getvalue())
+
+    if cache is not None:
+        cache.trim()
+
+
+def _diff_member(conv, a, b):
+    """ Return the lines describing how the raw member a differs from b """
+    import difflib
+    import jsondiff
+
+    if isinstance(conv, converters.JSONConverter):
+        return [jsondiff.format_change(*change) for change in jsondiff.diff(conv.parse_raw(a), conv.parse_raw(b))]
+    texts = []
+    for raw in (a, b):
+        out = StringIO()
+        conv.write_raw_to_textconv(raw, out)
+        texts.append(out.getvalue().rstrip("\n").split("\n"))
+    # (skipping the ---/+++ header lines - we already know what's being compared)
+    return list(difflib.unified_diff(*texts, n=1, lineterm=''))[2:]
+
+
+def diff_pbit(a_path, b_path, outio):
+    """
+    Print a compact diff of the pbits a_path and b_path to outio, returning the number of members that differ. Members
+    whose CRC and size match (as recorded in the zip central directories) are taken to be the same without being
+    decompressed at all. Only the rest are converted: json members are diffed object by object (see jsondiff), and
+    anything else as a unified diff of its textconv output.
+    """
+    import zipfile
+
+    with zipfile.ZipFile(a_path) as za, zipfile.ZipFile(b_path) as zb:
+        a_infos = {info.filename: info for info in za.infolist()}
+        b_infos = {info.filename: info for info in zb.infolist()}
+        differ = 0
+        for name in za.namelist() + [name for name in zb.namelist() if name not in a_infos]:
+            if name not in b_infos:
+                print("- " + name, file=outio)
+                differ += 1
+                continue
+            if name not in a_infos:
+                print("+ " + name, file=outio)
+                differ += 1
+                continue
+            a_info, b_info = a_infos[name], b_infos[name]
+            if a_info.CRC == b_info.CRC and a_info.file_size == b_info.file_size:
+                continue
+            conv = find_converter(name)
+            with conv.measure(name, a_info.file_size + b_info.file_size):
+                lines = _diff_member(conv, za.read(name), zb.read(name))
+            if not lines:
+                # e.g. only the formatting or key order differs
+                continue
+            differ += 1
+            print("~ " + name, file=outio)
+            for line in lines:
+                print("    " + line, file=outio)
+    return differ
+
+
+def _verify_member(pbit_path, name):
+    """
+    Round trip member name of the pbit at pbit_path through its vcs form, in memory, returning (name, converter name,
+    status, detail): status being 'identical' (the rebuilt bytes are exactly the original ones), 'reformatted' (they
+    differ, but extract to exactly the same vcs form, so nothing is lost) or 'FAILED'. The rebuilt member is only
+    hashed, not kept - it's only rebuilt again (in to memory) if it differs, to extract it for comparison.
+    """
+    import zipfile
+
+    conv = find_converter(name)
+    convname = type(conv).__name__
+    try:
+        with zipfile.ZipFile(pbit_path) as zd, zd.open(name) as f:
+            rawf = converters.HashingReader(f)
+            b = rawf.read()
+            raw_hash = rawf.hexdigest()
+        with conv.measure(name, len(b)):
+            files = conv.raw_to_vcs_files(b)
+            rebuilt = converters.HashingWriter()
+            conv.write_vcs_files_to_raw(files, converters.stats_writer(rebuilt))
+            if rebuilt.hexdigest() == raw_hash:
+                return name, convname, 'identical', None
+            rebuilt = BytesIO()
+            conv.write_vcs_files_to_raw(files, rebuilt)
+            refiles = conv.raw_to_vcs_files(rebuilt.getvalue())
+    except Exception as e:
+        return name, convname, 'FAILED', '{0}: {1}'.format(type(e).__name__, e)
+    changed = sorted(path or name for path in set(files) | set(refiles) if files.get(path) != refiles.get(path))
+    if changed:
+        return name, convname, 'FAILED', 'extracts differently once compressed: ' + ', '.join(changed)
+    return name, convname, 'reformatted', None
+
+
+def verify_pbit(pbit_path, outio, jobs=None):
+    """
+    Check that each member of a pbit survives being extracted and compressed again (see _verify_member), all in
+    memory, reporting the result for each member to outio. If jobs > 1, members are checked across that many worker
+    processes. Each member is only read (by whichever process checks it) when it's checked, so at most jobs members
+    are in memory at once. Returns the number of failures.
+    """
+    import zipfile
+
+    counts = {'identical': 0, 'reformatted': 0, 'FAILED': 0}
+    with zipfile.ZipFile(pbit_path) as zd:
+        names = zd.namelist()
+    for name, convname, status, detail in _map_members(_verify_member, ((pbit_path, name) for name in names), jobs):
+        counts[status] += 1
+        print('{0:12} {1:20} {2}{3}'.format(status, convname, name, ': ' + detail if detail else ''), file=outio)
+    print('{0} members: {1} identical, {2} reformatted, {3} failed'.format(
+        len(names), counts['identical'], counts['reformatted'], counts['FAILED']), file=outio)
+    return counts['FAILED']
+
+
+def _textconv_cache(args):
+    if not args.textconv_cache:
+        return None
+    from cache import TextconvCache
+
+    return TextconvCache(os.path.expanduser(args.textconv_cache), args.textconv_cache_size * 1024 * 1024)
+
+
+def clean_pbit(b, pathname=None):
+    """
+    Convert the content of a pbit to the flattened (single text file) VCS format, for use as a git clean filter.
+    Anything that isn't a zip (e.g. something already cleaned) is passed through.
+    """
+    import gitfilter
+    import tempfile
+
+    if not b.startswith(b'PK'):
+        return b
+    with tempfile.TemporaryDirectory() as tmpdir:
+        outdir = os.path.join(tmpdir, 'vcs')
+        extract_pbit(BytesIO(b), outdir, False)
+        return gitfilter.flatten_dir(outdir)
+
+
+def smudge_pbit(b, pathname=None):
+    """
+    Undo clean_pbit, for use as a git smudge filter. Anything that isn't in the flattened format (e.g. a pbit committed
+    before the filter was set up) is passed through.
+    """
+    import gitfilter
+    import tempfile
+
+    if not b.startswith(gitfilter.FILE_HEADER.encode('utf-8')):
+        return b
+    with tempfile.TemporaryDirectory() as tmpdir:
+        vcsdir = os.path.join(tmpdir, 'vcs')
+        gitfilter.unflatten_to_dir(b, vcsdir)
+        compress_pbit(vcsdir, os.path.join(tmpdir, 'out.pbit'), False)
+        with open(os.path.join(tmpdir, 'out.pbit'), 'rb') as f:
+            return f.read()
+
+
+def serve_textconv(address, cache=None, errio=sys.stderr):
+    """
+    Serve textconv requests (made by textconv_via_server) on address (a unix socket path, or a named pipe on Windows)
+    forever, so that the converters only have to be loaded once.
+    """
+    from multiprocessing.connection import Listener
+
+    # tidy up the socket left behind by a server that was killed:
+    if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode) and not _server_running(address):
+        os.remove(address)
+
+    with Listener(address) as listener:
+        print('pbivcs: serving textconv on "{0}"'.format(listener.address), file=errio)
+        while True:
+            try:
+                with listener.accept() as conn:
+                    # (only raw bytes are exchanged - never pickles - so clients can't run code here)
+                    path = conn.recv_bytes().decode('utf-8')
+                    out = StringIO()
+                    try:
+                        textconv_pbit(path, out, cache=cache)
+                    except Exception as e:
+                        conn.send_bytes(b'E' + '{0}: {1}'.format(type(e).__name__, e).encode('utf-8'))
+                    else:
+                        conn.send_bytes(b'O' + out.getvalue().encode('utf-8'))
+            except (OSError, EOFError) as e:
+                print('pbivcs: textconv connection failed: {0}'.format(e), file=errio)
+
+
+def _server_running(address):
+    from multiprocessing.connection import Client
+
+    try:
+        Client(address).close()
+    except OSError:
+        return False
+    return True
+
+
+def textconv_via_server(address, pbit_path, outio):
+    """
+    Have the textconv server at address convert pbit_path, writing the result to outio. Returns False (having written
+    nothing) if the server couldn't be reached.
+    """
+    from multiprocessing.connection import Client
+
+    try:
+        conn = Client(address)
+    except OSError:
+        return False
+    with conn:
+        conn.send_bytes(os.path.abspath(pbit_path).encode('utf-8'))
+        reply = conn.recv_bytes()
+    if reply[:1] == b'E':
+        raise Exception(reply[1:].decode('utf-8'))
+    outio.write(reply[1:].decode('utf-8'))
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def _confs_above(folder):
+    """ The .pbivcs.conf files in folder and each of its parents, root first (cached, as batch inputs share parents) """
+    parent = os.path.dirname(folder)
+    confs = _confs_above(parent) if parent != folder else ()
+    confpath = os.path.join(folder, '.pbivcs.conf')
+    return confs + (confpath,) if os.path.isfile(confpath) else confs
+
 
 def _find_confs(path):
     """
-    Find all .pbivcs.conf files (if any) furthest down the path, ordered by hierarchy i.e.
-    '/path/to/my/.pbivcs.conf' would come before '/path/to/.pbivcs.conf'
+    Find all .pbivcs.conf files (if any) in the folders above path, ordered by hierarchy i.e.
+    '/path/to/.pbivcs.conf' would come before '/path/to/my/.pbivcs.conf' - so that the latter, the nearest, takes
+    precedence (as configargparse lets each config file override the ones before it)
     """
+    return list(_confs_above(os.path.dirname(os.path.abspath(path))))
 
-    splat = tuple(i for i in os.path.split(os.path.abspath(os.path.normpath(path))) if i)
-    confs = []
-    for i in range(1, len(splat)):
-        parent = os.path.join(*splat[:i])
-        confpath = os.path.join(parent, '.pbivcs.conf')
-        if os.path.exists(confpath):
-            confs.append(confpath)
-    return confs
 
-if __name__ == '__main__':
+def _build_parser(config_files=()):
+    """
+    The argument parser - reading config_files if there are any, which needs configargparse. Otherwise it's a plain
+    argparse one (which parses exactly the same), to save loading configargparse.
+    """
+    description = "A utility for converting *.pbit files to and from a VCS-friendly format"
+    if config_files:
+        import configargparse
 
-    import configargparse
+        parser = configargparse.ArgumentParser(description=description, default_config_files=list(config_files))
+    else:
+        import argparse
 
-    parser = configargparse.ArgumentParser(description="A utility for converting *.pbit files to and from a VCS-friendly format")
-    parser.add_argument('input', type=str, help="the input path")
+        parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('input', type=str, help="the input path", nargs="?", default=None)
     parser.add_argument('output', type=str, help="the output path", nargs="?", default=None)
     parser.add_argument('-x', action='store_true', dest="extract", default=True, help="extract pbit at INPUT to VCS-friendly format at OUTPUT")
     parser.add_argument('-c', action='store_false', dest="extract", default=True, help="compress VCS-friendly format at INPUT to pbit at OUTPUT")
     parser.add_argument('-s', action='store_true', dest="textconv", default=False, help="extract pbit at INPUT to textconv format on stdout")
+    parser.add_argument('--verify', action='store_true', dest="verify", default=False, help="check (in memory) that every member of the pbit at INPUT survives being extracted and compressed again, reporting any that don't (exiting with 1 if any fail). Members are checked across --member-jobs processes (default: one per core)")
+    parser.add_argument('--diff', action='store_true', dest="diff", default=False, help="print a structural diff of the pbits at INPUT and OUTPUT (exiting with 1 if they differ), only converting the members whose CRCs differ")
     parser.add_argument('--over-write', action='store_true', dest="overwrite", default=False, help="if present, allow overwriting of OUTPUT. If not, will fail if OUTPUT exists")
-    # parse args first to get input path:
-    input_path = parser.parse_args().input
-    # now set config files for parser:
-    parser._default_config_files = _find_confs(input_path)
-    # now parse again to get final args:
-    args = parser.parse_args()
-
-    if args.textconv:
-        textconv_pbit(args.input, sys.stdout)
+    parser.add_argument('--incremental', action='store_true', dest="incremental", default=False, help="if present, update an existing extracted OUTPUT in place, only rewriting the members that changed")
+    parser.add_argument('--shard-layout', action='store_true', dest="shard_layout", default=False, help="when extracting, split Report/Layout in to a folder with a file per page and per visual, so editing one visual only changes one small file (compressing detects this by itself)")
+    parser.add_argument('--member-jobs', type=int, dest="member_jobs", default=None, help="convert the members of a pbit across this many worker processes (the output is identical either way)")
+    parser.add_argument('--batch', action='store_true', dest="batch", default=False, help="treat INPUT as a directory, glob or manifest file (one path per line) of inputs, each extracted to/compressed from a sibling '.vcs' folder")
+    parser.add_argument('-j', '--jobs', type=int, dest="jobs", default=None, help="number of worker processes for --batch (defaults to the number of cores)")
+    parser.add_argument('--filter-process', action='store_true', dest="filter_process", default=False, help="serve git's long-running filter process protocol on stdin/stdout (clean: pbit to flattened VCS format; smudge: back again)")
+    parser.add_argument('--serve-textconv', type=str, dest="serve_textconv", default=None, metavar="ADDRESS", help="serve textconv requests on the unix socket (or Windows named pipe) at ADDRESS, for use with --textconv-server")
+    parser.add_argument('--textconv-server', type=str, dest="textconv_server", default=None, metavar="ADDRESS", help="with -s, have the server at ADDRESS (started with --serve-textconv) do the conversion, if it's running")
+    parser.add_argument('--textconv-cache', type=str, dest="textconv_cache", default=None, metavar="DIR", help="cache the textconv output of each member in DIR, so members that are unchanged between revisions are only converted once")
+    parser.add_argument('--textconv-cache-size', type=int, dest="textconv_cache_size", default=256, metavar="MB", help="the most the textconv cache may grow to before the least recently used entries are evicted")
+    parser.add_argument('--watch', type=str, dest="watch", default=None, metavar="DIR", help="keep running, extracting every *.pbit under DIR which is new or changes (once it's completely written) to its sibling '.pbit.vcs' folder, incrementally")
+    parser.add_argument('--watch-debounce', type=float, dest="watch_debounce", default=2.0, metavar="SECONDS", help="with --watch, only extract a *.pbit once it's been left alone for this long")
+    parser.add_argument('--watch-interval', type=float, dest="watch_interval", default=2.0, metavar="SECONDS", help="with --watch, how often to look for changes where inotify isn't available (or can't be used)")
+    parser.add_argument('--watch-poll', action='store_true', dest="watch_poll", default=False, help="with --watch, always look for changes every --watch-interval seconds, rather than using inotify (e.g. if DIR is shared with other machines in a way that isn't detected)")
+    parser.add_argument('--stats', action='store_true', dest="stats", default=False, help="print the converter, input/output size and read/convert/write time of each member to stderr")
+    parser.add_argument('--stats-json', type=str, dest="stats_json", default=None, metavar="PATH", help="save the --stats for each member (and totals per converter) as JSON to PATH")
+    parser.add_argument('--profile', type=str, dest="profile", default=None, metavar="PATH", help="profile the whole run with cProfile, saving the results to PATH")
+    parser.add_argument('--raw-store', type=str, dest="raw_store", default=None, metavar="DIR", help="when extracting, keep the original compressed stream of each member in DIR; when compressing, copy it straight across for any member whose VCS form is unchanged, rather than deflating it again")
+    parser.add_argument('--blob-store', type=str, dest="blob_store", default=None, metavar="DIR", help="when extracting, stream pass-through members (e.g. images, or a pbix's DataModel) of at least --blob-min-size in to the content-addressed store at DIR, outside the repo, leaving just a small pointer file in OUTPUT; when compressing, stream them back from it")
+    parser.add_argument('--blob-min-size', type=int, dest="blob_min_size", default=64, metavar="KB", help="the smallest member to put in the --blob-store")
+    parser.add_argument('--blob-gc', type=str, dest="blob_gc", action='append', default=[], metavar="ROOT", help="remove every blob from the --blob-store that isn't pointed to from under ROOT (or by any commit of the git repo it's in). Repeat it for every folder/repo using the store - anything not listed loses its blobs")
+    parser.add_argument('--compress-level', type=str, dest="compress_levels", action='append', default=[], metavar="CONVERTER=LEVEL", help="when compressing, use this deflate LEVEL (0-9, or 'stored' for no compression) for members handled by CONVERTER (e.g. NoopConverter=stored or JSONConverter=9) - which are then always converted and compressed afresh, even if they could be copied from --raw-store. Can be repeated")
+    return parser
+
+
+def _compress_levels(parser, specs):
+    names = sorted({type(conv).__name__ for pattern, conv in SHARDED_CONVERTERS + CONVERTERS} | {BlobConverter.__name__})
+    levels = {}
+    for spec in specs:
+        conv, sep, level = spec.partition('=')
+        if not sep or not (level == 'stored' or level.isdigit() and 0 <= int(level) <= 9):
+            parser.error('Error! --compress-level should be CONVERTER=LEVEL with LEVEL 0-9 or stored, not "{0}"'.format(spec))
+        if conv.strip() not in names:
+            parser.error('Error! Unknown converter "{0}" in --compress-level (should be one of {1})'.format(
+                conv.strip(), ', '.join(names)))
+        levels[conv.strip()] = level if level == 'stored' else int(level)
+    return levels
+
+
+def _raw_store(args):
+    if not args.raw_store:
+        return None
+    from rawstore import RawStore
+
+    return RawStore(os.path.expanduser(args.raw_store))
+
+
+def _blob_store(args):
+    return BlobStore(os.path.expanduser(args.blob_store), args.blob_min_size * 1024) if args.blob_store else None
+
+
+def _parse_args(argv=None, conf_path=None):
+    """
+    Parse the arguments, using the .pbivcs.conf files found for conf_path (defaulting to the input path, or the folder
+    being watched with --watch, or if there's neither, e.g. for --filter-process, the current folder). Without a
+    conf_path, argv is parsed first to get the input path, but only parsed again if there are config files to read.
+    """
+    if conf_path is not None:
+        parser = _build_parser(_find_confs(conf_path))
+        args = parser.parse_args(argv)
+    else:
+        parser = _build_parser()
+        args = parser.parse_args(argv)
+        if args.input:
+            confs = _find_confs(args.input)
+        else:
+            confs = list(_confs_above(os.path.abspath(args.watch) if args.watch else os.getcwd()))
+        if confs:
+            parser = _build_parser(confs)
+            args = parser.parse_args(argv)
+    args.compress_levels = _compress_levels(parser, args.compress_levels)
+    return parser, args
+
+
+def _batch_inputs(spec, extract):
+    """
+    Expand a --batch INPUT into the paths to process: a directory (searched recursively for *.pbit, or *.pbit.vcs
+    folders when compressing), a manifest file listing one path per line (relative to the manifest), or a glob.
+    """
+    import glob
+    import zipfile
+
+    if os.path.isdir(spec):
+        if extract:
+            return sorted(glob.glob(os.path.join(glob.escape(spec), '**', '*.pbit'), recursive=True))
+        return sorted(p for p in glob.glob(os.path.join(glob.escape(spec), '**', '*.pbit.vcs'), recursive=True)
+                      if os.path.isdir(p))
+    if os.path.isfile(spec) and not zipfile.is_zipfile(spec):
+        with open(spec) as f:
+            lines = [l.strip() for l in f.read().split("\n")]
+        return [os.path.join(os.path.dirname(spec), l) for l in lines if l and not l.startswith('#')]
+    return sorted(glob.glob(spec, recursive=True))
+
+
+def _batch_output(path, extract):
+    if extract:
+        return path + '.vcs'
+    if not path.endswith('.vcs'):
+        raise Exception('Cannot work out output path for "{0}" (expected it to end in ".vcs")'.format(path))
+    return path[:-len('.vcs')]
+
+
+def _batch_one(argv, path):
+    """
+    Process a single --batch input (in a worker process), resolving its own .pbivcs.conf files. Returns
+    (path, output path, error message or None) so that one failure doesn't stop the rest.
+    """
+    outpath = None
+    try:
+        parser, args = _parse_args(argv, path)
+        outpath = _batch_output(path, args.extract)
+        if args.extract:
+            extract_pbit(path, outpath, args.overwrite, args.incremental, args.member_jobs, _raw_store(args),
+                         args.shard_layout, _blob_store(args))
+        else:
+            compress_pbit(path, outpath, args.overwrite, args.member_jobs, _raw_store(args),
+                          args.compress_levels, _blob_store(args))
+    except Exception as e:
+        return path, outpath, '{0}: {1}'.format(type(e).__name__, e)
+    return path, outpath, None
+
+
+def _watch_extract(argv, path, outdir):
+    """ Extract a *.pbit that --watch (as per argv) has found changed, resolving its own .pbivcs.conf files """
+    # (we may have been running a while, so look for the .pbivcs.conf files afresh)
+    _confs_above.cache_clear()
+    try:
+        parser, args = _parse_args(argv, path)
+    except SystemExit:
+        # (the error's already been printed - but don't stop watching everything else)
+        raise Exception('Invalid arguments for "{0}" (see above)'.format(path))
+    extract_pbit(path, outdir, False, True, args.member_jobs, _raw_store(args), args.shard_layout, _blob_store(args))
+
+
+def batch(argv, paths, jobs=None, outio=sys.stderr):
+    """
+    Extract/compress (as per argv) each of paths across a pool of jobs worker processes (default: one per core),
+    reporting the result of each to outio as it completes. Returns the number of failures.
+    """
+    import concurrent.futures
+
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_batch_one, argv, path) for path in paths]
+        for future in concurrent.futures.as_completed(futures):
+            path, outpath, error = future.result()
+            if error is None:
+                print('ok: "{0}" -> "{1}"'.format(path, outpath), file=outio)
+            else:
+                failures += 1
+                print('FAILED: "{0}": {1}'.format(path, error), file=outio)
+    print('{0} of {1} succeeded'.format(len(paths) - failures, len(paths)), file=outio)
+    return failures
+
+
+def _run(parser, args):
+    """ Do whatever args ask, returning the exit code """
+    if args.filter_process:
+        import gitfilter
+
+        gitfilter.filter_process({'clean': clean_pbit, 'smudge': smudge_pbit})
+    elif args.serve_textconv:
+        serve_textconv(args.serve_textconv, _textconv_cache(args))
+    elif args.watch:
+        import watch
+
+        watch.watch(args.watch, functools.partial(_watch_extract, sys.argv[1:]), args.watch_debounce,
+                    args.watch_interval, args.watch_poll)
+    elif args.blob_gc:
+        if not args.blob_store:
+            parser.error('Error! --blob-gc needs a --blob-store')
+        removed, freed = _blob_store(args).gc(args.blob_gc)
+        print('removed {0} blobs ({1:.1f} MB)'.format(removed, freed / 1024 / 1024), file=sys.stderr)
+    elif args.input is None:
+        parser.error('the following arguments are required: input')
+    elif args.batch:
+        if args.textconv or args.diff or args.verify:
+            parser.error('Error! --batch cannot be used with -s, --diff or --verify')
+        paths = _batch_inputs(args.input, args.extract)
+        if not paths:
+            parser.error('Error! No inputs found for "{0}"'.format(args.input))
+        return 1 if batch(sys.argv[1:], paths, args.jobs) else 0
+    elif args.verify:
+        return 1 if verify_pbit(args.input, sys.stdout, args.member_jobs or os.cpu_count()) else 0
+    elif args.diff:
+        if args.output is None:
+            parser.error('the following arguments are required: output')
+        return 1 if diff_pbit(args.input, args.output, sys.stdout) else 0
+    elif args.textconv:
+        if not (args.textconv_server and textconv_via_server(args.textconv_server, args.input, sys.stdout)):
+            textconv_pbit(args.input, sys.stdout, args.member_jobs, _textconv_cache(args))
     else:
         if args.output is None:
             parser.error('the following arguments are required: output')
@@ -156,6 +795,36 @@ if __name__ == '__main__':
             parser.error('Error! Input and output paths cannot be same')
 
         if args.extract:
-            extract_pbit(args.input, args.output, args.overwrite)
+            extract_pbit(args.input, args.output, args.overwrite, args.incremental, args.member_jobs, _raw_store(args),
+                         args.shard_layout, _blob_store(args))
         else:
-            compress_pbit(args.input, args.output, args.overwrite)
+            compress_pbit(args.input, args.output, args.overwrite, args.member_jobs, _raw_store(args),
+                          args.compress_levels, _blob_store(args))
+    return 0
+
+
+if __name__ == '__main__':
+
+    parser, args = _parse_args()
+
+    if (args.stats or args.stats_json or args.profile) and (args.batch or args.filter_process or args.serve_textconv or args.watch):
+        parser.error('Error! --stats, --stats-json and --profile cannot be used with --batch, --filter-process, --serve-textconv or --watch')
+    if args.stats or args.stats_json:
+        converters.Converter.stats = converters.Stats()
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        code = _run(parser, args)
+    finally:
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.stats:
+            converters.Converter.stats.summary(sys.stderr)
+        if args.stats_json:
+            with open(args.stats_json, 'w') as f:
+                json.dump(converters.Converter.stats.to_dict(), f, indent=2)
+    sys.exit(code)
@@ -0,0 +1,166 @@
+import functools
+import json
+import os
+import shutil
+import struct
+import zipfile
+from io import BytesIO
+
+from converters import CHUNK_SIZE
+from store import atomic_write, entry_key, entry_path
+
+# the private parts of ZipFile which write_compressed needs to write a member without compressing it:
+ZIPFILE_INTERNALS = ('_lock', '_writecheck', '_didModify', 'start_dir', 'fp', 'filelist', 'NameToInfo')
+
+
+def write_compressed(zd, zinfo, f):
+    """
+    Write zinfo.compress_size bytes of already-compressed data from f straight in to the ZipFile zd (open for writing)
+    as the member zinfo, which must already have the right compress_type, CRC and sizes.
+
+    ZipFile has no public way of doing this, so _write_compressed_directly does what ZipFile.open(zinfo, 'w') does
+    itself, using its private lock, _writecheck etc. (it's the only place that does). That's only trusted if this
+    zipfile has them all and they do what we expect (see _can_write_directly) - otherwise the data is decompressed and
+    written through ZipFile.open(zinfo, 'w') instead, compressing it all over again, but still correct.
+    """
+    if all(hasattr(zd, attr) for attr in ZIPFILE_INTERNALS) and _can_write_directly():
+        _write_compressed_directly(zd, zinfo, f)
+    else:
+        _write_decompressed(zd, zinfo, f)
+
+
+def _write_compressed_directly(zd, zinfo, f):
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    if not zinfo.external_attr:
+        zinfo.external_attr = 0o600 << 16  # as ZipFile.open(name, 'w') does
+    with zd._lock:
+        zd._writecheck(zinfo)
+        zd._didModify = True
+        zd.fp.seek(zd.start_dir)
+        zinfo.header_offset = zd.fp.tell()
+        zd.fp.write(zinfo.FileHeader(zip64))
+        shutil.copyfileobj(f, zd.fp, CHUNK_SIZE)
+        zd.filelist.append(zinfo)
+        zd.NameToInfo[zinfo.filename] = zinfo
+        zd.start_dir = zd.fp.tell()
+
+
+def _write_decompressed(zd, zinfo, f):
+    if zinfo.compress_type == zipfile.ZIP_STORED:
+        decompress = bytes
+    elif zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        import zlib
+
+        decompress = zlib.decompressobj(-zlib.MAX_WBITS).decompress
+    else:
+        raise Exception('Cannot copy "{0}" (compression type {1})'.format(zinfo.filename, zinfo.compress_type))
+    remaining = zinfo.compress_size  # (before ZipFile.open resets it)
+    with zd.open(zinfo, 'w', force_zip64=zinfo.file_size > zipfile.ZIP64_LIMIT) as z:
+        while remaining:
+            b = f.read(min(remaining, CHUNK_SIZE))
+            if not b:
+                raise zipfile.BadZipFile('Truncated member "{0}"'.format(zinfo.filename))
+            z.write(decompress(b))
+            remaining -= len(b)
+
+
+@functools.lru_cache(maxsize=None)
+def _can_write_directly():
+    """
+    Whether _write_compressed_directly works with this version of zipfile: it's used to copy a member between members
+    written the usual way, and the result must pass testzip and read back exactly as expected (checked once per
+    process, as it only depends on the zipfile module)
+    """
+    import zlib
+
+    expected = [('a', b'before'), ('b', b'copied ' * 100), ('c', b'after')]
+    try:
+        # the compressed stream to copy:
+        src = BytesIO()
+        with zipfile.ZipFile(src, 'w', zipfile.ZIP_DEFLATED) as zd:
+            zd.writestr('b', expected[1][1])
+        with zipfile.ZipFile(src) as zd:
+            copied = zd.getinfo('b')
+            zd.fp.seek(copied.header_offset + zipfile.sizeFileHeader + len(copied.orig_filename.encode('utf-8'))
+                       + len(copied.extra))
+            stream = zd.fp.read(copied.compress_size)
+        if zlib.decompress(stream, -zlib.MAX_WBITS) != expected[1][1]:
+            return False
+
+        out = BytesIO()
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zd:
+            zd.writestr('a', expected[0][1])
+            zinfo = zipfile.ZipInfo('b')
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.CRC, zinfo.file_size, zinfo.compress_size = copied.CRC, copied.file_size, copied.compress_size
+            _write_compressed_directly(zd, zinfo, BytesIO(stream))
+            zd.writestr('c', expected[2][1])
+        with zipfile.ZipFile(out) as zd:
+            return zd.testzip() is None and [(name, zd.read(name)) for name in zd.namelist()] == expected
+    except Exception:
+        return False
+
+
+class RawStore:
+    """
+    An out-of-tree, content-addressed store of the original compressed streams of pbit members, keyed by the hash of
+    their extracted (VCS) form and the converter used. When compressing, a member whose VCS form is unchanged since it
+    was extracted then has its original compressed bytes copied straight in to the new pbit, rather than being
+    converted and deflated all over again (which also means it comes out exactly as it went in).
+
+    Each entry is a file holding a line of JSON (the CRC, sizes and compression method) followed by the compressed
+    stream itself.
+    """
+
+    SUFFIX = '.zraw'
+
+    def __init__(self, path):
+        self.path = path
+
+    def key(self, vcs_hash, conv):
+        return entry_key(vcs_hash, conv)
+
+    def _entry_path(self, key):
+        return entry_path(self.path, key, self.SUFFIX)
+
+    def has(self, key):
+        return os.path.isfile(self._entry_path(key))
+
+    def put_from_zip(self, key, zd, name):
+        """ Store the compressed stream of member name of the (open) ZipFile zd, without decompressing it """
+        zinfo = zd.getinfo(name)
+        if zinfo.flag_bits & 0x1:
+            # encrypted - not that pbits ever are ...
+            return
+        fp = zd.fp
+        fp.seek(zinfo.header_offset)
+        header = fp.read(zipfile.sizeFileHeader)
+        if header[:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile('Bad local file header for "{0}"'.format(name))
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        fp.seek(zinfo.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+
+        with atomic_write(self._entry_path(key)) as f:
+            meta = {'crc': zinfo.CRC, 'file_size': zinfo.file_size, 'compress_size': zinfo.compress_size,
+                    'compress_type': zinfo.compress_type}
+            f.write(json.dumps(meta).encode('utf-8') + b'\n')
+            remaining = zinfo.compress_size
+            while remaining:
+                b = fp.read(min(remaining, CHUNK_SIZE))
+                if not b:
+                    raise zipfile.BadZipFile('Truncated member "{0}"'.format(name))
+                f.write(b)
+                remaining -= len(b)
+
+    def copy_to_zip(self, key, zd, zinfo):
+        """
+        Write the stored compressed stream straight in to the ZipFile zd (open for writing) as the member zinfo (a
+        ZipInfo with its name, date etc. - its compression and sizes are set from the store)
+        """
+        with open(self._entry_path(key), 'rb') as f:
+            meta = json.loads(f.readline().decode('utf-8'))
+            zinfo.compress_type = meta['compress_type']
+            zinfo.CRC = meta['crc']
+            zinfo.file_size = meta['file_size']
+            zinfo.compress_size = meta['compress_size']
+            write_compressed(zd, zinfo, f)
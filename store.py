@@ -0,0 +1,36 @@
+"""
+What the on-disk, content-addressed stores (TextconvCache, RawStore, BlobStore and backfill's members) have in common:
+how entries are keyed and laid out, and writing them so that concurrent readers never see a partial entry.
+"""
+
+import contextlib
+import hashlib
+import os
+
+
+def entry_key(content_hash, conv):
+    """ The key of the entry for content (with the given hash) as converted by conv """
+    return hashlib.sha256('{0}\0{1}'.format(content_hash, conv.cache_id()).encode('utf-8')).hexdigest()
+
+
+def entry_path(root, key, suffix=''):
+    """ Where the entry key lives under root (fanned out by the first two characters, to keep folders small) """
+    return os.path.join(root, key[:2], key + suffix)
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='wb'):
+    """
+    Open a temporary file next to path to write to, which is only renamed over path once it's been completely written
+    (and is removed if writing fails).
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmppath = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmppath, mode) as f:
+            yield f
+        os.replace(tmppath, path)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
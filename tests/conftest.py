@@ -0,0 +1,22 @@
+import os
+import sys
+import zipfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SAMPLES = os.path.join(ROOT, 'samples')
+
+
+@pytest.fixture
+def sample_pbit():
+    """ A small sample pbit (with a DataMashup) """
+    return os.path.join(SAMPLES, 'Retail Analysis Sample PBIX.pbit')
+
+
+def read_members(path):
+    """ {name: bytes} of every member of the zip at path, in order """
+    with zipfile.ZipFile(path) as zd:
+        return {name: zd.read(name) for name in zd.namelist()}
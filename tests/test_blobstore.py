@@ -0,0 +1,72 @@
+import os
+from io import BytesIO
+
+import pytest
+
+import blobstore
+import pbivcs
+from conftest import read_members
+
+
+def test_put_and_copy_to(tmp_path):
+    store = blobstore.BlobStore(str(tmp_path / 'blobs'))
+    content = os.urandom(3 << 20)  # (a few chunks)
+    digest, size = store.put(BytesIO(content))
+    assert size == len(content)
+    assert store.put(BytesIO(content)) == (digest, size)
+    assert sum(len(files) for root, dirs, files in os.walk(store.path)) == 1
+    out = BytesIO()
+    store.copy_to(digest, size, out)
+    assert out.getvalue() == content
+
+
+def test_copy_to_checks_the_blob(tmp_path):
+    store = blobstore.BlobStore(str(tmp_path / 'blobs'))
+    digest, size = store.put(BytesIO(b'content'))
+    with open(store._blob_path(digest), 'wb') as f:
+        f.write(b'tampered')
+    with pytest.raises(Exception, match='corrupt'):
+        store.copy_to(digest, size, BytesIO())
+    with pytest.raises(Exception, match='missing'):
+        store.copy_to('0' * 64, 1, BytesIO())
+
+
+def test_pointers():
+    p = blobstore.pointer('ab' * 32, 123)
+    assert blobstore.parse_pointer(p) == ('ab' * 32, 123)
+    assert blobstore.parse_pointer(b'just some content') is None
+    with pytest.raises(Exception):
+        blobstore.parse_pointer(blobstore.POINTER_HEADER + b'sha256 x\n')
+
+
+def test_gc_keeps_whatever_is_pointed_to(tmp_path):
+    store = blobstore.BlobStore(str(tmp_path / 'blobs'))
+    kept = store.put(BytesIO(b'kept'))
+    store.put(BytesIO(b'garbage'))
+    root = tmp_path / 'repo'
+    root.mkdir()
+    (root / 'member').write_bytes(blobstore.pointer(*kept))
+    # (recently stored blobs are never collected)
+    assert store.gc([str(root)]) == (0, 0)
+    assert store.gc([str(root)], grace=-1) == (1, len(b'garbage'))
+    out = BytesIO()
+    store.copy_to(*kept, out)
+    assert out.getvalue() == b'kept'
+    with pytest.raises(Exception, match='does not exist'):
+        store.gc([str(tmp_path / 'typo')], grace=-1)
+
+
+def test_extract_and_compress_with_a_blob_store(sample_pbit, tmp_path):
+    store = blobstore.BlobStore(str(tmp_path / 'blobs'), min_size=1024)
+    outdir = str(tmp_path / 'vcs')
+    pbivcs.extract_pbit(sample_pbit, outdir, False, blob_store=store)
+    pointers = list(blobstore.find_pointers(outdir))
+    assert pointers and all(size >= 1024 for digest, size in pointers)
+
+    pbivcs.compress_pbit(outdir, str(tmp_path / 'out.pbit'), False, blob_store=store)
+    fresh = str(tmp_path / 'fresh')
+    pbivcs.extract_pbit(sample_pbit, fresh, False)
+    pbivcs.compress_pbit(fresh, str(tmp_path / 'fresh.pbit'), False)
+    assert read_members(str(tmp_path / 'out.pbit')) == read_members(str(tmp_path / 'fresh.pbit'))
+    with pytest.raises(Exception, match='needs a blob store'):
+        pbivcs.compress_pbit(outdir, str(tmp_path / 'no-store.pbit'), False)
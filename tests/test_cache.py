@@ -0,0 +1,55 @@
+import os
+
+from cache import TextconvCache
+from converters import JSONConverter, NoopConverter
+
+
+def _entries(cache):
+    return sorted(name[:-len(cache.SUFFIX)] for root, dirs, files in os.walk(cache.path)
+                  for name in files if name.endswith(cache.SUFFIX))
+
+
+def test_keys_depend_on_the_converter(tmp_path):
+    cache = TextconvCache(str(tmp_path), 1000)
+    assert cache.key('abc', NoopConverter()) == cache.key('abc', NoopConverter())
+    assert cache.key('abc', NoopConverter()) != cache.key('abc', JSONConverter('utf-8'))
+    assert cache.key('abc', JSONConverter('utf-8')) != cache.key('abc', JSONConverter('utf-16-le'))
+
+
+def test_get_and_put(tmp_path):
+    cache = TextconvCache(str(tmp_path), 1000)
+    assert cache.get('a' * 64) is None
+    cache.put('a' * 64, 'café\n')
+    assert cache.get('a' * 64) == 'café\n'
+    assert TextconvCache(str(tmp_path), 1000).get('a' * 64) == 'café\n'
+
+
+def test_trim_evicts_the_least_recently_used(tmp_path):
+    cache = TextconvCache(str(tmp_path), 250)
+    for i, key in enumerate(('a' * 64, 'b' * 64, 'c' * 64)):
+        cache.put(key, 'x' * 100)
+        os.utime(cache._entry_path(key), (1000 + i, 1000 + i))
+    cache.get('a' * 64)  # (now the most recently used)
+    cache.trim()
+    assert _entries(cache) == ['a' * 64, 'c' * 64]
+
+
+def test_trim_only_scans_when_it_may_be_too_big(tmp_path, monkeypatch):
+    cache = TextconvCache(str(tmp_path), 250)
+    cache.put('a' * 64, 'x' * 100)
+    cache.trim()  # (the first trim has to scan, to find the size)
+
+    scans = []
+    real_walk = os.walk
+    monkeypatch.setattr(os, 'walk', lambda path: scans.append(path) or real_walk(path))
+    cache = TextconvCache(str(tmp_path), 250)
+    cache.trim()  # nothing put
+    cache.get('a' * 64)
+    cache.trim()  # nothing put
+    cache.put('b' * 64, 'x' * 100)
+    cache.trim()  # still only 200 bytes
+    assert scans == []
+    cache.put('c' * 64, 'x' * 100)
+    cache.trim()
+    assert scans == [str(tmp_path)]
+    assert len(_entries(cache)) == 2
@@ -0,0 +1,107 @@
+import ast
+import json
+import os
+import struct
+import zipfile
+from io import BytesIO
+
+import pytest
+
+import converters
+import pbivcs
+
+
+def _sample_member(sample_pbit, name):
+    with zipfile.ZipFile(sample_pbit) as zd:
+        return zd.read(name)
+
+
+def test_metadata_round_trip(sample_pbit):
+    conv = converters.MetadataConverter()
+    for b in (_sample_member(sample_pbit, 'Metadata'), bytes(range(256)) * 2, b"'\"\\\n\r\t", b''):
+        vcs = conv.raw_to_vcs(b)
+        # (it's the repr, split over lines - and parses back as a python literal would)
+        assert vcs.replace(b'\n', b'') == repr(b).encode('ascii')
+        assert ast.literal_eval(vcs.replace(b'\n', b'').decode('ascii')) == b
+        assert conv.vcs_to_raw(vcs) == b
+        assert conv.vcs_to_raw(vcs.replace(b'\n', b'\r\n')) == b
+
+
+def test_metadata_unescapes_like_python():
+    conv = converters.MetadataConverter()
+    for literal in (rb"b'\x41\101\0\377'", rb'b"it\'s"', rb"b'\a\b\f\v'"):
+        assert conv.vcs_to_raw(literal) == ast.literal_eval(literal.decode('ascii'))
+
+
+def _layout(sections):
+    return json.dumps({'id': 0, 'config': json.dumps({'version': '5'}), 'sections': sections},
+                      separators=(',', ':')).encode('utf-16-le')
+
+
+def _visual(name, x):
+    return {'x': x, 'config': json.dumps({'name': name, 'singleVisual': {'visualType': 'card'}})}
+
+
+def _flat_round_trip(b):
+    conv = converters.JSONConverter('utf-16-le')
+    return conv.vcs_to_raw(conv.raw_to_vcs(b))
+
+
+def test_sharded_layout_round_trips(tmp_path):
+    conv = converters.ShardedLayoutConverter('utf-16-le')
+    layouts = [
+        _layout([{'name': 'ReportSection', 'visualContainers': [_visual('a', 1), _visual('b', 2)]},
+                 {'name': 'ReportSection2', 'visualContainers': []}]),
+        # names that aren't usable as file names, or clash (even case-insensitively), or are missing:
+        _layout([{'name': '../bad/name', 'visualContainers': [_visual('A', 1), _visual('a', 2), {'x': 3}]},
+                 {'name': '.hidden'}, {'name': '_0'}, {}]),
+        # nothing to shard:
+        _layout('not a list'),
+    ]
+    for i, b in enumerate(layouts):
+        outdir = str(tmp_path / str(i))
+        conv.write_raw_to_vcs(b, outdir)
+        out = BytesIO()
+        conv.write_vcs_to_raw(outdir, out)
+        assert out.getvalue() == _flat_round_trip(b)
+
+        out = BytesIO()
+        conv.write_vcs_files_to_raw(conv.raw_to_vcs_files(b), out)
+        assert out.getvalue() == _flat_round_trip(b)
+
+
+def test_sharded_layout_only_rewrites_what_changed(tmp_path):
+    conv = converters.ShardedLayoutConverter('utf-16-le')
+    outdir = str(tmp_path / 'Layout')
+    conv.write_raw_to_vcs(_layout([{'name': 's', 'visualContainers': [_visual('a', 1), _visual('b', 2),
+                                                                      _visual('gone', 3)]}]), outdir)
+    before = {os.path.relpath(os.path.join(root, name), outdir): os.stat(os.path.join(root, name)).st_mtime_ns
+              for root, dirs, files in os.walk(outdir) for name in files}
+    os.utime(os.path.join(outdir, 'layout.json'), ns=(1, 1))
+    conv.write_raw_to_vcs(_layout([{'name': 's', 'visualContainers': [_visual('b', 2), _visual('a', 5)]}]), outdir)
+    after = {os.path.relpath(os.path.join(root, name), outdir): os.stat(os.path.join(root, name)).st_mtime_ns
+             for root, dirs, files in os.walk(outdir) for name in files}
+    vcs_dir = os.path.join('sections', 's', 'visualContainers')
+    assert os.path.join(vcs_dir, 'gone.json') not in after
+    assert os.stat(os.path.join(outdir, 'layout.json')).st_mtime_ns == 1
+    assert after[os.path.join(vcs_dir, 'b.json')] == before[os.path.join(vcs_dir, 'b.json')]
+
+
+def test_sharded_sample_compresses_as_flat(sample_pbit, tmp_path):
+    for shard_layout in (False, True):
+        outdir = str(tmp_path / str(shard_layout))
+        pbivcs.extract_pbit(sample_pbit, outdir, False, shard_layout=shard_layout)
+        pbivcs.compress_pbit(outdir, outdir + '.pbit', False)
+    with zipfile.ZipFile(str(tmp_path / 'False.pbit')) as flat, zipfile.ZipFile(str(tmp_path / 'True.pbit')) as sharded:
+        assert flat.read('Report/Layout') == sharded.read('Report/Layout')
+
+
+def _mashup(*lengths):
+    return b'\x00' * 4 + b''.join(struct.pack('<I', length) for length in lengths) + b'x' * 16
+
+
+def test_datamashup_rejects_bad_lengths():
+    # a length that would be negative if read as signed, one past the end, and a bad length of the second xml
+    for b in (_mashup(0xFFFFFFF0), _mashup(17), _mashup(0, 0, 0xFFFFFFFF, 0, 1)):
+        with pytest.raises(ValueError):
+            converters.DataMashupConverter.Sections(b)
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+import converters
+import pbivcs
+from conftest import read_members
+
+
+def _leftover_tmp_files(outdir):
+    return [name for root, dirs, files in os.walk(outdir) for name in files if name.endswith('.pbivcs-tmp')]
+
+
+def _check_round_trip(sample_pbit, outdir, tmp_path):
+    """ Check outdir compresses to the same as a fresh extract does, and nothing's left behind """
+    fresh = str(tmp_path / 'fresh')
+    pbivcs.extract_pbit(sample_pbit, fresh, True)
+    pbivcs.compress_pbit(fresh, str(tmp_path / 'fresh.pbit'), True)
+    pbivcs.compress_pbit(outdir, str(tmp_path / 'out.pbit'), True)
+    assert read_members(str(tmp_path / 'out.pbit')) == read_members(str(tmp_path / 'fresh.pbit'))
+    assert _leftover_tmp_files(outdir) == []
+
+
+def test_turning_shard_layout_on(sample_pbit, tmp_path):
+    outdir = str(tmp_path / 'vcs')
+    pbivcs.extract_pbit(sample_pbit, outdir, False)
+    # (e.g. from an older version, without a manifest)
+    if os.path.exists(os.path.join(outdir, '.zh')):
+        os.remove(os.path.join(outdir, '.zh'))
+    pbivcs.extract_pbit(sample_pbit, outdir, False, incremental=True, shard_layout=True)
+    assert os.path.isdir(os.path.join(outdir, 'Report', 'Layout'))
+    _check_round_trip(sample_pbit, outdir, tmp_path)
+
+
+def test_turning_shard_layout_off(sample_pbit, tmp_path):
+    outdir = str(tmp_path / 'vcs')
+    pbivcs.extract_pbit(sample_pbit, outdir, False, shard_layout=True)
+    if os.path.exists(os.path.join(outdir, '.zh')):
+        os.remove(os.path.join(outdir, '.zh'))
+    pbivcs.extract_pbit(sample_pbit, outdir, False, incremental=True)
+    assert os.path.isfile(os.path.join(outdir, 'Report', 'Layout'))
+    _check_round_trip(sample_pbit, outdir, tmp_path)
+
+
+def test_switching_with_a_manifest(sample_pbit, tmp_path):
+    outdir = str(tmp_path / 'vcs')
+    for shard_layout in (False, True, False):
+        pbivcs.extract_pbit(sample_pbit, outdir, False, incremental=True, shard_layout=shard_layout)
+        assert os.path.isdir(os.path.join(outdir, 'Report', 'Layout')) == shard_layout
+        _check_round_trip(sample_pbit, outdir, tmp_path)
+
+
+def test_changed_file_writer_tidies_up_a_failed_replace(tmp_path):
+    path = tmp_path / 'member'
+    (path / 'in-the-way').mkdir(parents=True)
+    with pytest.raises(OSError):
+        converters.write_if_changed(str(path), b'content')
+    assert sorted(os.listdir(str(tmp_path))) == ['member']
+
+
+def _manifests(outdir):
+    return sorted(os.path.relpath(root, outdir) for root, dirs, files in os.walk(outdir)
+                  if converters.MANIFEST_FILE in files)
+
+
+def test_only_incremental_extracts_write_manifests(sample_pbit, tmp_path):
+    outdir = str(tmp_path / 'vcs')
+    pbivcs.extract_pbit(sample_pbit, outdir, False)
+    assert _manifests(outdir) == []
+    pbivcs.extract_pbit(sample_pbit, outdir, False, incremental=True)
+    assert _manifests(outdir) == ['.', 'DataMashup']
+
+
+def test_incremental_extract_restores_edited_output(sample_pbit, tmp_path):
+    outdir = str(tmp_path / 'vcs')
+    pbivcs.extract_pbit(sample_pbit, outdir, False, incremental=True)
+    fresh = {path: open(os.path.join(outdir, path), 'rb').read() for path in ('DiagramState', 'DataMashup/3.xml')}
+    for path in fresh:
+        with open(os.path.join(outdir, path), 'ab') as f:
+            f.write(b'edited')
+    pbivcs.extract_pbit(sample_pbit, outdir, False, incremental=True)
+    assert {path: open(os.path.join(outdir, path), 'rb').read() for path in fresh} == fresh
@@ -0,0 +1,78 @@
+from io import BytesIO, StringIO
+
+import gitfilter
+import pbivcs
+from conftest import read_members
+
+
+def _request(command, pathname, content):
+    f = BytesIO()
+    gitfilter.write_pkt_list(f, ['command=' + command, 'pathname=' + pathname])
+    gitfilter.write_pkt_content(f, content)
+    return f.getvalue()
+
+
+def _serve(requests, commands):
+    """ Run filter_process over the handshake and requests, returning its output stream (rewound) and errors """
+    fin = BytesIO()
+    gitfilter.write_pkt_list(fin, ['git-filter-client', 'version=2'])
+    gitfilter.write_pkt_list(fin, ['capability=clean', 'capability=smudge', 'capability=delay'])
+    fin.write(b''.join(requests))
+    fin.seek(0)
+    fout, errio = BytesIO(), StringIO()
+    gitfilter.filter_process(commands, fin, fout, errio)
+    fout.seek(0)
+    return fout, errio.getvalue()
+
+
+def _clean(b, pathname):
+    if not b:
+        raise ValueError('Nothing to clean')
+    return b.upper()
+
+
+def test_handshake_and_requests():
+    big = bytes(range(256)) * 1000  # (more than one packet)
+    fout, errors = _serve([_request('clean', 'a.pbit', b'abc'), _request('smudge', 'b.pbit', big),
+                           _request('clean', 'bad.pbit', b'')],
+                          {'clean': _clean, 'smudge': lambda b, path: b[::-1]})
+    assert gitfilter.read_pkt_list(fout) == ['git-filter-server', 'version=2']
+    assert gitfilter.read_pkt_list(fout) == ['capability=clean', 'capability=smudge']  # (not delay)
+    assert gitfilter.read_pkt_list(fout) == ['status=success']
+    assert gitfilter.read_pkt_content(fout) == b'ABC'
+    assert gitfilter.read_pkt_list(fout) == []
+    assert gitfilter.read_pkt_list(fout) == ['status=success']
+    assert gitfilter.read_pkt_content(fout) == big[::-1]
+    assert gitfilter.read_pkt_list(fout) == []
+    assert gitfilter.read_pkt_list(fout) == ['status=error']
+    assert fout.read() == b''
+    assert 'bad.pbit' in errors
+
+
+def test_flatten_round_trip(tmp_path):
+    files = {'text': b'line\n', 'noeol': b'no newline', 'empty': b'', 'binary': b'\x00\xff\xfe',
+             'crlf': b'a\r\nb\x0c\n', 'sub/dir/clash': gitfilter.FILE_HEADER.encode('utf-8') + b'x text\n'}
+    src = tmp_path / 'src'
+    for path, b in files.items():
+        (src / path).parent.mkdir(parents=True, exist_ok=True)
+        (src / path).write_bytes(b)
+    flat = gitfilter.flatten_dir(str(src))
+    gitfilter.unflatten_to_dir(flat, str(tmp_path / 'dst'))
+    assert {path: (tmp_path / 'dst' / path).read_bytes() for path in files} == files
+
+
+def test_clean_and_smudge_a_pbit(sample_pbit, tmp_path):
+    with open(sample_pbit, 'rb') as f:
+        b = f.read()
+    cleaned = pbivcs.clean_pbit(b)
+    assert cleaned.startswith(gitfilter.FILE_HEADER.encode('utf-8'))
+    assert b'.zh text' not in cleaned
+    # (already clean, or not a pbit, is passed through):
+    assert pbivcs.clean_pbit(cleaned) == cleaned
+    assert pbivcs.smudge_pbit(b) == b
+
+    (tmp_path / 'smudged.pbit').write_bytes(pbivcs.smudge_pbit(cleaned))
+    outdir = str(tmp_path / 'vcs')
+    pbivcs.extract_pbit(sample_pbit, outdir, False)
+    pbivcs.compress_pbit(outdir, str(tmp_path / 'compressed.pbit'), False)
+    assert read_members(str(tmp_path / 'smudged.pbit')) == read_members(str(tmp_path / 'compressed.pbit'))
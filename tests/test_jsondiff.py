@@ -0,0 +1,19 @@
+from jsondiff import diff
+
+
+def test_a_number_changing_type_in_a_keyed_item_is_a_change():
+    old = {'t': [{'name': 'a', 'v': 1}]}
+    new = {'t': [{'name': 'a', 'v': 1.0}]}
+    assert list(diff(old, new)) == [('~', 't[name=a].v', 1, 1.0)]
+
+
+def test_types_are_compared_all_the_way_down():
+    assert list(diff({'x': [[{'y': True}]]}, {'x': [[{'y': 1}]]})) == [('~', 'x[0][0].y', True, 1)]
+    assert list(diff({'x': [[{'y': 1}]]}, {'x': [[{'y': 1}]]})) == []
+
+
+def test_keyed_items_are_matched_by_name():
+    old = {'tables': [{'name': 'a', 'v': 1}, {'name': 'b', 'v': 2}]}
+    new = {'tables': [{'name': 'c', 'v': 3}, {'name': 'a', 'v': 1}, {'name': 'b', 'v': 5}]}
+    assert list(diff(old, new)) == [('~', 'tables[name=b].v', 2, 5),
+                                    ('+', 'tables[name=c]', None, {'name': 'c', 'v': 3})]
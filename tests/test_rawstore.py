@@ -0,0 +1,77 @@
+import zipfile
+
+import pytest
+
+import pbivcs
+import rawstore
+from conftest import read_members
+from converters import NoopConverter
+
+MEMBERS = [('stored', b'not compressed', zipfile.ZIP_STORED), ('deflated', b'compressed ' * 1000, zipfile.ZIP_DEFLATED),
+           ('empty', b'', zipfile.ZIP_DEFLATED)]
+
+
+@pytest.fixture(params=['directly', 'decompressed'])
+def write_path(request, monkeypatch):
+    """ Run the test with both of write_compressed's ways of writing """
+    if request.param == 'decompressed':
+        monkeypatch.setattr(rawstore, '_can_write_directly', lambda: False)
+    return request.param
+
+
+def test_can_write_directly_with_this_zipfile():
+    assert rawstore._can_write_directly()
+
+
+def test_copied_members_match_a_normal_zipfile_write(tmp_path, write_path):
+    normal = str(tmp_path / 'normal.zip')
+    with zipfile.ZipFile(normal, 'w') as zd:
+        for name, b, compress_type in MEMBERS:
+            zd.writestr(name, b, compress_type)
+
+    store = rawstore.RawStore(str(tmp_path / 'store'))
+    conv = NoopConverter()
+    with zipfile.ZipFile(normal) as zd:
+        for name, b, compress_type in MEMBERS:
+            store.put_from_zip(store.key(name, conv), zd, name)
+
+    copied = str(tmp_path / 'copied.zip')
+    with zipfile.ZipFile(copied, 'w', zipfile.ZIP_DEFLATED) as zd:
+        zd.writestr('first', b'written normally')
+        for name, b, compress_type in MEMBERS:
+            assert store.has(store.key(name, conv))
+            store.copy_to_zip(store.key(name, conv), zd, zipfile.ZipInfo(name))
+        zd.writestr('last', b'written normally')
+
+    with zipfile.ZipFile(copied) as zd:
+        assert zd.testzip() is None
+        assert [(name, zd.read(name)) for name in zd.namelist()] == (
+            [('first', b'written normally')] + [(name, b) for name, b, compress_type in MEMBERS]
+            + [('last', b'written normally')])
+        if write_path == 'directly':
+            # (exactly the same streams)
+            with zipfile.ZipFile(normal) as original:
+                assert all(zd.getinfo(name).compress_size == original.getinfo(name).compress_size
+                           for name, b, compress_type in MEMBERS)
+
+
+def test_compressing_from_the_raw_store(sample_pbit, tmp_path, write_path):
+    store = rawstore.RawStore(str(tmp_path / 'store'))
+    outdir = str(tmp_path / 'vcs')
+    pbivcs.extract_pbit(sample_pbit, outdir, False, raw_store=store)
+    pbivcs.compress_pbit(outdir, str(tmp_path / 'out.pbit'), False, raw_store=store)
+    with zipfile.ZipFile(str(tmp_path / 'out.pbit')) as zd:
+        assert zd.testzip() is None
+    assert read_members(str(tmp_path / 'out.pbit')) == read_members(sample_pbit)
+
+
+def test_compress_levels_take_priority_over_the_raw_store(sample_pbit, tmp_path):
+    store = rawstore.RawStore(str(tmp_path / 'store'))
+    outdir = str(tmp_path / 'vcs')
+    pbivcs.extract_pbit(sample_pbit, outdir, False, raw_store=store)
+    pbivcs.compress_pbit(outdir, str(tmp_path / 'out.pbit'), False, raw_store=store,
+                         compress_levels={'NoopConverter': 'stored'})
+    with zipfile.ZipFile(str(tmp_path / 'out.pbit')) as zd:
+        assert zd.getinfo('Version').compress_type == zipfile.ZIP_STORED
+        assert zd.getinfo('DataModelSchema').compress_type == zipfile.ZIP_DEFLATED
+    assert read_members(str(tmp_path / 'out.pbit')) == read_members(sample_pbit)
@@ -0,0 +1,46 @@
+import os
+from io import StringIO
+
+import converters
+import pbivcs
+from conftest import read_members
+
+
+def _record_stats(fn, *args):
+    converters.Converter.stats = converters.Stats()
+    try:
+        fn(*args)
+        return converters.Converter.stats
+    finally:
+        converters.Converter.stats = None
+
+
+def _records(stats):
+    return {record['name']: record for record in stats.members}
+
+
+def test_extract_stats_include_sub_members_but_not_bookkeeping(sample_pbit, tmp_path):
+    outdir = str(tmp_path / 'vcs')
+    records = _records(_record_stats(pbivcs.extract_pbit, sample_pbit, outdir, False, True))
+    section_sizes = sum(record['out_size'] for name, record in records.items() if name.startswith('DataMashup/'))
+    assert records['DataMashup']['out_size'] == section_sizes
+    assert section_sizes == sum(os.path.getsize(os.path.join(root, name))
+                                for root, dirs, files in os.walk(os.path.join(outdir, 'DataMashup'))
+                                for name in files if name not in ('.zo', converters.MANIFEST_FILE))
+
+
+def test_compress_stats_count_nested_output_once(sample_pbit, tmp_path):
+    outdir = str(tmp_path / 'vcs')
+    pbivcs.extract_pbit(sample_pbit, outdir, False)
+    compressed = str(tmp_path / 'out.pbit')
+    records = _records(_record_stats(pbivcs.compress_pbit, outdir, compressed, False))
+    assert records['DataMashup']['out_size'] == len(read_members(compressed)['DataMashup'])
+
+
+def test_summary_keeps_sub_members_under_their_member(sample_pbit, tmp_path):
+    stats = _record_stats(pbivcs.extract_pbit, sample_pbit, str(tmp_path / 'vcs'), False)
+    out = StringIO()
+    stats.summary(out)
+    names = [line.split()[0] for line in out.getvalue().split("\n")[1:] if line.strip() and not line.startswith('(')]
+    first = names.index('DataMashup')
+    assert all(name.startswith('DataMashup/') for name in names[first + 1:first + 7])
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import shutil
+import time
+import zipfile
+from io import StringIO
+
+import pytest
+
+import converters
+import pbivcs
+import watch
+
+STEP = 0.02  # how long each of _ScriptedWatcher's waits takes, at most
+DEBOUNCE = 0.15
+
+
+class _Stop(Exception):
+    pass
+
+
+class _ScriptedWatcher:
+    """ Runs one of steps (returning the paths it changed) each time watch waits, then stops watch """
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+
+    def wait(self, timeout=None):
+        time.sleep(STEP if timeout is None else min(timeout, STEP))
+        if not self.steps:
+            raise _Stop()
+        return self.steps.pop(0)() or []
+
+    def close(self):
+        pass
+
+
+def _write_pbit(path, content):
+    with zipfile.ZipFile(path, 'w') as zd:
+        zd.writestr('Version', content)
+
+
+def _watch(root, steps):
+    """ Run watch over the steps, returning [(path, sha256 of it when it was extracted)] and what it printed """
+    extracted = []
+
+    def extract(path, outdir):
+        with open(path, 'rb') as f:
+            extracted.append((path, hashlib.sha256(f.read()).hexdigest()))
+        os.makedirs(outdir, exist_ok=True)
+        open(os.path.join(outdir, converters.MANIFEST_FILE), 'w').close()
+
+    errio = StringIO()
+    with pytest.raises(_Stop):
+        watch.watch(root, extract, DEBOUNCE, errio=errio, watcher=_ScriptedWatcher(steps))
+    return extracted, errio.getvalue()
+
+
+def _idle(seconds):
+    return [lambda: None] * int(seconds / STEP)
+
+
+def _sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_each_report_uses_its_own_conf(sample_pbit, tmp_path):
+    for folder, conf in (('sharded', 'shard-layout = true\n'), ('plain', None)):
+        os.makedirs(str(tmp_path / folder))
+        if conf:
+            (tmp_path / folder / '.pbivcs.conf').write_text(conf)
+        shutil.copy(sample_pbit, str(tmp_path / folder / 'report.pbit'))
+    argv = ['--watch', str(tmp_path)]
+    for folder in ('sharded', 'plain'):
+        path = str(tmp_path / folder / 'report.pbit')
+        pbivcs._watch_extract(argv, path, path + '.vcs')
+    assert os.path.isdir(str(tmp_path / 'sharded' / 'report.pbit.vcs' / 'Report' / 'Layout'))
+    assert os.path.isfile(str(tmp_path / 'plain' / 'report.pbit.vcs' / 'Report' / 'Layout'))
+
+
+def test_only_extracts_once_writing_has_settled(tmp_path):
+    path = str(tmp_path / 'report.pbit')
+
+    def rewrite(i):
+        def step():
+            _write_pbit(path, 'version {0}'.format('x' * i))
+            return [path]
+        return step
+
+    # keep rewriting it for longer than the debounce period, then leave it alone:
+    rewrites = [rewrite(i) for i in range(int(2 * DEBOUNCE / STEP))]
+    extracted, printed = _watch(str(tmp_path), rewrites + _idle(3 * DEBOUNCE))
+    assert extracted == [(path, _sha256(path))]
+
+
+def test_extracts_whatever_changed_before_it_started(tmp_path):
+    old, new = str(tmp_path / 'old.pbit'), str(tmp_path / 'new.pbit')
+    for path in (old, new):
+        _write_pbit(path, 'v1')
+    os.makedirs(old + '.vcs')
+    open(os.path.join(old + '.vcs', converters.MANIFEST_FILE), 'w').close()
+    os.utime(old, (1, 1))  # (extracted since it last changed)
+    extracted, printed = _watch(str(tmp_path), _idle(3 * DEBOUNCE))
+    assert extracted == [(new, _sha256(new))]
+
+
+def test_skips_incomplete_pbits(tmp_path):
+    path = str(tmp_path / 'report.pbit')
+
+    def write_partial():
+        with open(path, 'wb') as f:
+            f.write(b'PK\x03\x04 and no more')
+        return [path]
+
+    extracted, printed = _watch(str(tmp_path), [write_partial] + _idle(3 * DEBOUNCE))
+    assert extracted == []
+    assert 'not a complete pbit' in printed
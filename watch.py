@@ -0,0 +1,302 @@
+"""
+Watch a folder (and everything under it) for *.pbit files being exported, and extract each one in to its sibling
+'.pbit.vcs' folder once it's been completely written. Changes are picked up with inotify where it's available (i.e. on
+Linux), so nothing is done while nothing changes, and otherwise by polling. inotify only sees changes made by this
+machine, so folders on network filesystems (and any inotify can't watch) are always polled. Extracts are incremental, so
+only the members which actually changed are converted again.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import struct
+import sys
+import time
+import zipfile
+
+import converters
+
+VCS_SUFFIX = '.vcs'
+
+# from <sys/inotify.h>:
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+# filesystems which may be written to by other machines (including Windows drives under WSL), which inotify won't see:
+NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', 'coda', '9p', 'drvfs', 'ceph',
+                       'glusterfs', 'lustre', 'gpfs', 'davfs', 'fuse.sshfs', 'fuse.glusterfs', 'fuse.cephfs',
+                       'fuse.rclone', 'fuse.s3fs'}
+MOUNTS_FILE = '/proc/self/mounts'
+
+
+def is_pbit(path):
+    return path.lower().endswith('.pbit')
+
+
+def _is_vcs_dir(name):
+    return name.endswith(VCS_SUFFIX) and is_pbit(name[:-len(VCS_SUFFIX)])
+
+
+def _walk_dirs(root):
+    """ Yield root and every folder under it, other than our own .pbit.vcs output folders """
+    for dirpath, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if not _is_vcs_dir(d)]
+        yield dirpath
+
+
+def find_pbits(root):
+    for dirpath in _walk_dirs(root):
+        for name in os.listdir(dirpath):
+            path = os.path.join(dirpath, name)
+            if is_pbit(name) and os.path.isfile(path):
+                yield path
+
+
+def _scan(top):
+    """ The _signature of every *.pbit under top """
+    return {path: _signature(path) for path in find_pbits(top)}
+
+
+def _read_mounts():
+    """ [(mount point, filesystem type)], deepest first (or [] if we can't tell, e.g. not on Linux) """
+    try:
+        with open(MOUNTS_FILE) as f:
+            lines = f.read().split("\n")
+    except OSError:
+        return []
+    mounts = []
+    for line in lines:
+        fields = line.split(' ')
+        if len(fields) >= 3:
+            # (spaces etc. in the mount point are octal escaped, e.g. '\040')
+            mounts.append((re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1]), fields[2]))
+    return sorted(mounts, key=lambda m: len(m[0]), reverse=True)
+
+
+def _is_network_fs(path, mounts):
+    """ Whether path is on one of NETWORK_FILESYSTEMS, going by mounts (from _read_mounts) """
+    path = os.path.realpath(path)
+    for mount_point, fstype in mounts:
+        if path == mount_point or path.startswith(mount_point.rstrip('/') + '/'):
+            return fstype in NETWORK_FILESYSTEMS
+    return False
+
+
+def _signature(path):
+    """ Something which changes whenever the file does (or None if it no longer exists) """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def _is_complete_zip(path):
+    """ Whether path is a readable zip (i.e. it's been completely written, central directory and all) """
+    try:
+        with zipfile.ZipFile(path):
+            return True
+    except (zipfile.BadZipFile, OSError):
+        return False
+
+
+def _out_of_date(path):
+    """ Whether path has changed since its vcs folder was last written by watch (or never been extracted) """
+    manifest = os.path.join(path + VCS_SUFFIX, converters.MANIFEST_FILE)
+    return not os.path.isfile(manifest) or os.path.getmtime(path) > os.path.getmtime(manifest)
+
+
+class PollingWatcher:
+    """ Finds changed *.pbit under root by rescanning it every interval seconds """
+
+    def __init__(self, root, interval):
+        self.root = root
+        self.interval = interval
+        self.seen = _scan(root)
+
+    def wait(self, timeout=None):
+        """ Wait (up to timeout seconds, if given) and return the paths of any *.pbit which may have changed """
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        seen = _scan(self.root)
+        changed = [path for path, sig in seen.items() if self.seen.get(path) != sig]
+        self.seen = seen
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Finds changed *.pbit under root with inotify (raising OSError if it's not available). Folders which are on a network
+    filesystem, or which can't be watched (e.g. max_user_watches has been hit), are rescanned every interval seconds
+    instead, along with everything under them.
+    """
+
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_ONLYDIR  # (only folders are watched)
+
+    def __init__(self, root, interval=2.0):
+        libc_name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError("inotify isn't available")
+        self.root = root
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}  # watch descriptor -> folder
+        self.interval = interval
+        self.polled = {}  # folder polled instead (with everything under it) -> the _scan of it last time
+        self.next_poll = time.monotonic() + interval
+        self._add_tree(root)
+
+    def _add_tree(self, top):
+        """ Watch (or poll) top and everything under it, returning any *.pbit already in there """
+        found = []
+        mounts = _read_mounts()
+        for dirpath, dirs, files in os.walk(top):
+            dirs[:] = [d for d in dirs if not _is_vcs_dir(d)]
+            if _is_network_fs(dirpath, mounts):
+                wd = -1
+            else:
+                wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath), self.MASK)
+                if wd < 0:
+                    # e.g. we've hit max_user_watches
+                    print('pbivcs: cannot watch "{0}" ({1}), polling it instead'.format(
+                        dirpath, os.strerror(ctypes.get_errno())), file=sys.stderr)
+            if wd < 0:
+                # (polling dirpath covers everything under it too)
+                dirs[:] = []
+                self.polled[dirpath] = _scan(dirpath)
+                found.extend(self.polled[dirpath])
+                continue
+            self.dirs[wd] = dirpath
+            found.extend(os.path.join(dirpath, name) for name in files if is_pbit(name))
+        return found
+
+    def _poll(self):
+        """ Rescan the polled folders, returning any *.pbit in them which have changed """
+        changed = []
+        for dirpath, seen in list(self.polled.items()):
+            if not os.path.isdir(dirpath):
+                del self.polled[dirpath]
+                continue
+            self.polled[dirpath] = _scan(dirpath)
+            changed.extend(path for path, sig in self.polled[dirpath].items() if seen.get(path) != sig)
+        self.next_poll = time.monotonic() + self.interval
+        return changed
+
+    def wait(self, timeout=None):
+        if self.polled:
+            until_poll = max(0, self.next_poll - time.monotonic())
+            timeout = until_poll if timeout is None else min(timeout, until_poll)
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        changed = self._read_events() if readable else []
+        if self.polled and time.monotonic() >= self.next_poll:
+            changed.extend(self._poll())
+        return changed
+
+    def _read_events(self):
+        changed = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, pos)
+                name = buf[pos + EVENT_HEADER.size:pos + EVENT_HEADER.size + length].rstrip(b'\0')
+                pos += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # we've missed some events, so everything may have changed:
+                    changed.extend(find_pbits(self.root))
+                    continue
+                if mask & (IN_IGNORED | IN_DELETE_SELF):
+                    self.dirs.pop(wd, None)
+                    continue
+                dirpath = self.dirs.get(wd)
+                if dirpath is None or not name:
+                    continue
+                path = os.path.join(dirpath, os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and not _is_vcs_dir(os.path.basename(path)):
+                        changed.extend(self._add_tree(path))
+                elif is_pbit(path):
+                    changed.append(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(root, interval, poll=False):
+    """ An InotifyWatcher for root if possible (unless poll is set, or root's on a network filesystem), else polling """
+    if poll or _is_network_fs(root, _read_mounts()):
+        return PollingWatcher(root, interval)
+    try:
+        return InotifyWatcher(root, interval)
+    except (OSError, AttributeError, TypeError):
+        # (e.g. not on Linux)
+        return PollingWatcher(root, interval)
+
+
+def watch(root, extract, debounce=2.0, interval=2.0, poll=False, errio=sys.stderr, watcher=None):
+    """
+    Call extract(path, vcs path) for every *.pbit under root which is new or has changed (including any that changed
+    before we started), forever. A file is only extracted once it's been left alone for debounce seconds and is a
+    complete zip, so exports in progress aren't picked up half written. If poll is set, root is always rescanned every
+    interval seconds rather than using inotify.
+    """
+    watcher = watcher or make_watcher(root, interval, poll)
+    print('pbivcs: watching "{0}" ({1})'.format(root, type(watcher).__name__), file=errio)
+    # path -> [when it last changed, its signature then]:
+    pending = {path: [time.monotonic(), _signature(path)] for path in find_pbits(root) if _out_of_date(path)}
+    done = {}
+    try:
+        while True:
+            now = time.monotonic()
+            timeout = max(0, min(t for t, sig in pending.values()) + debounce - now) if pending else None
+            for path in watcher.wait(timeout):
+                pending[path] = [time.monotonic(), _signature(path)]
+
+            now = time.monotonic()
+            for path, (t, sig) in list(pending.items()):
+                if now - t < debounce:
+                    continue
+                current = _signature(path)
+                if current is None or current == done.get(path):
+                    # gone, or already extracted as it is
+                    del pending[path]
+                elif current != sig:
+                    # still being written - give it another debounce period:
+                    pending[path] = [now, current]
+                else:
+                    del pending[path]
+                    done[path] = current
+                    if not _is_complete_zip(path):
+                        print('pbivcs: skipping "{0}" (not a complete pbit)'.format(path), file=errio)
+                        continue
+                    try:
+                        extract(path, path + VCS_SUFFIX)
+                        # mark it up to date, for next time we start:
+                        os.utime(os.path.join(path + VCS_SUFFIX, converters.MANIFEST_FILE))
+                    except Exception as e:
+                        print('pbivcs: FAILED to extract "{0}": {1}: {2}'.format(path, type(e).__name__, e),
+                              file=errio)
+                    else:
+                        print('pbivcs: extracted "{0}"'.format(path), file=errio)
+    finally:
+        watcher.close()